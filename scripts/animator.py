@@ -5,13 +5,16 @@
 # Poor img2img implentation, will trash images that aren't moving.
 #
 # See https://github.com/Animator-Anon/Animator
+import html
 import json
+import math
 import os
 import time
 import gradio as gr
 import torch
 import numpy as np
-from scripts.functions import prepwork, sequential, loopback, export
+from scripts.functions import prepwork, sequential, loopback, export, frame_store, frame_writer, prop_cache, \
+    segments, sources
 from modules import script_callbacks, shared, sd_models, scripts, ui_common, ui
 from modules.call_queue import wrap_gradio_gpu_call
 from modules.shared import cmd_opts
@@ -48,6 +51,16 @@ def myprocess(*args, **kwargs):
     _vid_webm
     _style_pos
     _style_neg
+    _batch_size
+    _variations
+    _frame_format
+    _frame_compression
+    _stream_video
+    _save_frames
+    _gif_scale
+    _gif_fps
+    _gif_drop_duplicates
+    _flow_smoothing
     """
 
     i = 0
@@ -99,6 +112,16 @@ def myprocess(*args, **kwargs):
     myset['vid_webm'] = args[i]; i+=1               # bool(_vid_webm),
     myset['_style_pos'] = args[i]; i+=1             # str(_style_pos).strip(),
     myset['_style_neg'] = args[i]; i+=1             # str(_style_neg).strip(),
+    myset['batch_size'] = args[i]; i+=1             # int(_batch_size),
+    myset['variations'] = args[i]; i+=1             # int(_variations),
+    myset['frame_format'] = args[i]; i+=1           # str(_frame_format),
+    myset['frame_compression'] = args[i]; i+=1      # int(_frame_compression),
+    myset['stream_video'] = args[i]; i+=1           # bool(_stream_video),
+    myset['save_frames'] = args[i]; i+=1            # bool(_save_frames),
+    myset['gif_scale'] = args[i]; i+=1              # float(_gif_scale),
+    myset['gif_fps'] = args[i]; i+=1                # float(_gif_fps),
+    myset['gif_drop_duplicates'] = args[i]; i+=1    # bool(_gif_drop_duplicates),
+    myset['flow_smoothing'] = args[i]; i+=1         # bool(_flow_smoothing),
     myset['source'] = ""
     myset['debug'] = os.path.exists('debug.txt')
 
@@ -141,24 +164,98 @@ def myprocess(*args, **kwargs):
         myset['initial_img'] = None
         myset['mask'] = None
 
+    if myset['film_interpolation'] and myset['frame_format'] not in frame_writer.FILM_FORMATS + ['raw']:
+        print(f"FILM can't read {myset['frame_format']} frames, saving as png instead.")
+        myset['frame_format'] = 'png'
+
+    # FILM can work through the frames while rendering, except when they are rendered on segment devices.
+    myset['film_chunk'] = 0
+    if myset['film_interpolation'] and (myset['loopback'] or len(sequential.segment_devices()) == 0):
+        myset['film_chunk'] = int(shared.opts.animatoranon_film_chunk)
+
+    if myset['stream_video'] and myset['film_interpolation']:
+        print("FILM needs all the frames first, videos will be made after rendering.")
+        myset['stream_video'] = False
+    if not myset['save_frames'] and not myset['stream_video']:
+        print("Frames are needed to make the videos, saving them anyway.")
+        myset['save_frames'] = True
+
     # Prepare the processing objects with default values.
     ptxt, pimg = prepwork.setup_processors(myset)
 
+    # Each loopback variation gets its own folder of frames and videos.
+    if myset['loopback'] and int(myset['variations']) > 1:
+        export.calc_FPS(myset)
+        output_sets = [dict(myset, output_path=path) for path in loopback.variation_paths(myset)]
+        for output_set in output_sets:
+            os.makedirs(output_set['output_path'], exist_ok=True)
+    else:
+        output_sets = [myset]
+
     # Make bat files before video incase we interrupt it, and so we can generate vids on the fly.
-    export.make_batch_files(myset)
+    for output_set in output_sets:
+        export.make_batch_files(output_set)
 
     # tmp_live_previews_enable = shared.opts.live_previews_enable
     # shared.opts.live_previews_enable = False
 
-    shared.state.interrupted = False
-    if myset['loopback']:
-        result = loopback.main_process(myset, ptxt, pimg)
-    else:
-        result = sequential.main_process(myset, ptxt)
+    # Frames kept in a frame store rather than files, for each output folder.
+    # Sized for the frames the loops write, total_frames counts the frames FILM makes from them.
+    stores = {}
+    if myset['frame_format'] == 'raw':
+        store_frames = segments.frame_index(math.ceil(myset['fps'] * myset['total_time']) - 1, myset) + 1
+        stores = {output_set['output_path']: frame_store.FrameStore.create(output_set['output_path'],
+                                                                           output_set['width'], output_set['height'],
+                                                                           store_frames)
+                  for output_set in output_sets}
+
+    # Videos encoded as the frames are made, for each output folder.
+    streams = {}
+    if myset['stream_video']:
+        streams = {output_set['output_path']: export.open_streams(output_set) for output_set in output_sets}
+
+    # FILM workers take frames like a video stream.
+    film_workers = {}
+    if myset['film_chunk'] > 0:
+        film_workers = {output_set['output_path']: [export.FilmWorker(output_set['output_path'],
+                                                                      myset['film_chunk'], myset['smoothing'],
+                                                                      myset['width'], myset['height'])]
+                        for output_set in output_sets}
+    writer_streams = {output_set['output_path']: streams.get(output_set['output_path'], []) +
+                      film_workers.get(output_set['output_path'], [])
+                      for output_set in output_sets}
+
+    prop_cache.sprites.budget = int(shared.opts.animatoranon_prop_cache_mb) * 1024 * 1024
 
-    if not shared.state.interrupted:
-        # Generation not cancelled, go ahead and render the videos without stalling.
-        export.make_videos(myset)
+    shared.state.interrupted = False
+    # Frames are saved in the background, everything must be on disk before the videos are made.
+    with frame_writer.FrameWriter(shared.opts.animatoranon_writer_threads, compress_level=myset['frame_compression'],
+                                  streams=writer_streams, save_frames=myset['save_frames'], stores=stores) as writer:
+        if myset['loopback']:
+            result = loopback.main_process(myset, ptxt, pimg, writer)
+        else:
+            result = sequential.main_process(myset, ptxt, writer)
+
+    video_results = []
+    for output_set in output_sets:
+        # Streamed videos are already finished, even if interrupted. Otherwise, segment rendering saves frames
+        # directly, they are made from the files like normal.
+        output_streams = streams.get(output_set['output_path'], [])
+        if any(stream.frames > 0 for stream in output_streams):
+            video_results += [stream.result for stream in output_streams if stream.result is not None]
+            continue
+        if not shared.state.interrupted:
+            # Generation not cancelled, go ahead and render the videos.
+            video_results += export.make_videos(output_set)
+
+    # Frames kept in a frame store can also be saved as image files, once the videos are made from the store.
+    if myset['frame_format'] == 'raw' and myset['save_frames'] and shared.opts.animatoranon_raw_frames_png:
+        for output_set in output_sets:
+            if os.path.exists(os.path.join(output_set['output_path'], frame_store.STORE_FILENAME)):
+                store = frame_store.FrameStore.open(output_set['output_path'])
+                store.materialize(output_set['output_path'], 'png', myset['frame_compression'],
+                                  shared.opts.animatoranon_writer_threads)
+                store.close()
 
     shared.state.end()
 
@@ -172,10 +269,22 @@ def myprocess(*args, **kwargs):
 
     # shared.opts.live_previews_enable = tmp_live_previews_enable
 
+    # Short, plain settings only. Keyframes, file lists and the like are in settings.txt.
     dict_str = '<ul>'
-    for i in myset.keys():
-        dict_str += f"<li>{i}:\t{myset[i]}</li>"
-    dict_str = '</ul>'
+    for key, value in myset.items():
+        if isinstance(value, (str, int, float, bool)) and len(str(value)) <= 200:
+            dict_str += f"<li>{html.escape(key)}:\t{html.escape(str(value))}</li>"
+    dict_str += '</ul>'
+
+    if len(video_results) > 0:
+        dict_str += '<p>Videos:</p><ul>'
+        for video in video_results:
+            if video['returncode'] == 0:
+                dict_str += f"<li>{video['filename']}: {video['seconds']:.1f}s</li>"
+            else:
+                dict_str += f"<li>{video['filename']}: failed after {video['seconds']:.1f}s, " \
+                            f"{html.escape(video['error'])}</li>"
+        dict_str += '</ul>'
 
     return result, dict_str
 
@@ -190,6 +299,10 @@ def ui_block_generation():
                     "<b>Seed Travel</b>: Allow use of sub seeds to 'smoothly' change from one seed to the next. Only "
                     "makes sense to use if you manually have some seeds set in the keyframes.<br>"
                     "<b>Restore Faces</b>: Same as the checkbox in the main tabs, tries to create realistic faces... "
+                    "<br>"
+                    "<b>Batch Size</b>: Number of frames generated together when not in loopback mode, or in "
+                    "loopback mode when the frames come from a video or images source. Not used with loopback "
+                    "variations, which fill the batch themselves. Higher is faster if your GPU has the memory for it."
                     "</p>")
         steps = gr.Slider(minimum=1, maximum=150, step=1, label="Sampling Steps", value=20)
         from modules.sd_samplers import samplers, samplers_for_img2img
@@ -212,6 +325,7 @@ def ui_block_generation():
 
         with gr.Row():
             restore_faces = gr.Checkbox(label='Restore Faces', value=False)
+            batch_size = gr.Slider(minimum=1, maximum=16, step=1, label='Batch Size', value=1)
 
         with gr.Row():
             with gr.Accordion("Initial Image", open=False):
@@ -225,7 +339,7 @@ def ui_block_generation():
                                        image_mode="RGBA")  # .style(height=512)
 
     return steps, sampler_name, width, height, cfg_scale, denoising_strength, seed, seed_travel, initial_img, \
-           restore_faces
+           restore_faces, batch_size
 
 
 def ui_block_animation():
@@ -243,10 +357,15 @@ def ui_block_animation():
                     "<a href=\"https://github.com/google-research/frame-interpolation\"><u>FILM</u></a> to do the "
                     "interpolation, it needs to be installed separately and a bat file created so this script can call "
                     "it. Smoothing frame count is handled different by FILM. Check readme file.</li>"
+                    "<li><b>Optical Flow Smoothing</b>: Smoothing frames follow the motion between frames instead of "
+                    "fading, using OpenCV. Done while rendering, FILM is used instead if both are checked.</li>"
                     "<li><b>Add Noise</b>: Add simple noise to the image in the form of random coloured circles. "
-                    "These can help the loopback mode create new content.</li> "
+                    "These can help the loopback mode create new content. The noise follows the seed, so a frame "
+                    "gets the same noise each time it is rendered.</li> "
                     "<li><b>Loopback Mode</b>: This is the img2img loopback mode where the resulting image, "
                     "before post processing, is pre-processed and fed back in..</li> "
+                    "<li><b>Variations</b>: In loopback mode, render this many versions of the animation at once, "
+                    "each with a different seed, into their own sub folders.</li> "
                     "</ul>")
         with gr.Row():
             total_time = gr.Number(label="Total Animation Length (s)", lines=1, value=10.0)
@@ -254,14 +373,17 @@ def ui_block_animation():
         with gr.Row():
             smoothing = gr.Slider(label="Smoothing_Frames", minimum=0, maximum=32, step=1, value=0)
             film_interpolation = gr.Checkbox(label="FILM Interpolation", value=False)
+            flow_smoothing = gr.Checkbox(label="Optical Flow Smoothing", value=False)
         with gr.Row():
             add_noise = gr.Checkbox(label="Add_Noise", value=False)
             noise_strength = gr.Slider(label="Noise Strength", minimum=0.0, maximum=1.0, step=0.01,
                                        value=0.10)
         with gr.Row():
             loopback_mode = gr.Checkbox(label='Loopback Mode', value=True)
+            variations = gr.Slider(label="Variations", minimum=1, maximum=8, step=1, value=1)
 
-    return total_time, fps, smoothing, film_interpolation, add_noise, noise_strength, loopback_mode
+    return total_time, fps, smoothing, film_interpolation, flow_smoothing, add_noise, noise_strength, loopback_mode, \
+        variations
 
 
 def ui_block_processing():
@@ -346,13 +468,27 @@ def ui_block_output():
             vid_mp4 = gr.Checkbox(label="MP4", value=False)
             vid_webm = gr.Checkbox(label="WEBM", value=True)
 
+        with gr.Row():
+            gif_scale = gr.Slider(label="GIF scale", minimum=0.1, maximum=1.0, step=0.05, value=0.5)
+            gif_fps = gr.Slider(label="GIF max FPS, 0 for no limit", minimum=0, maximum=60, step=1, value=15)
+            gif_drop_duplicates = gr.Checkbox(label="GIF drop duplicate frames", value=True)
+
+        with gr.Row():
+            frame_format = gr.Dropdown(label="Frame format", choices=frame_writer.FRAME_FORMATS, value='png')
+            frame_compression = gr.Slider(label="Frame compression", minimum=0, maximum=9, step=1, value=6)
+
+        with gr.Row():
+            stream_video = gr.Checkbox(label="Encode videos while rendering", value=False)
+            save_frames = gr.Checkbox(label="Save frames", value=True)
+
         with gr.Row():
             btn_proc = gr.Button(value="Process", variant='primary', elem_id="animator_extension_procbutton")
             btn_stop = gr.Button(value='Stop', elem_id="animator_extension_stopbutton")
 
         # gallery = gr.Gallery(label="gallery", show_label=True).style(grid=5, height="auto")
 
-    return vid_gif, vid_mp4, vid_webm, btn_proc, btn_stop
+    return vid_gif, vid_mp4, vid_webm, gif_scale, gif_fps, gif_drop_duplicates, frame_format, frame_compression, \
+        stream_video, save_frames, btn_proc, btn_stop
 
 
 #
@@ -366,10 +502,10 @@ def on_ui_tabs():
             with gr.Column():
                 with gr.Tab("Generation"):
                     steps, sampler_name, width, height, cfg_scale, denoising_strength, seed, seed_travel, image_list, \
-                        restore_faces = ui_block_generation()
+                        restore_faces, batch_size = ui_block_generation()
 
-                    total_time, fps, smoothing, film_interpolation, add_noise, noise_strength, loopback_mode = \
-                        ui_block_animation()
+                    total_time, fps, smoothing, film_interpolation, flow_smoothing, add_noise, noise_strength, \
+                        loopback_mode, variations = ui_block_animation()
 
                     prompt_interpolation, tmpl_pos, style_pos, tmpl_neg, style_neg = ui_block_processing()
 
@@ -380,7 +516,8 @@ def on_ui_tabs():
 
             # Right Column
             with gr.Column():
-                vid_gif, vid_mp4, vid_webm, btn_proc, btn_stop = ui_block_output()
+                vid_gif, vid_mp4, vid_webm, gif_scale, gif_fps, gif_drop_duplicates, frame_format, \
+                    frame_compression, stream_video, save_frames, btn_proc, btn_stop = ui_block_output()
 
                 with gr.Blocks(variant="panel"):
                     # aa_htmlinfo_x elem_id=f'html_info_x_animator_extension'
@@ -399,7 +536,9 @@ def on_ui_tabs():
                        inputs=[aa_htmlinfo, steps, sampler_name, width, height, cfg_scale, denoising_strength,
                                total_time, fps, smoothing, film_interpolation, add_noise, noise_strength, seed,
                                seed_travel, restore_faces, image_list, loopback_mode, prompt_interpolation,
-                               tmpl_pos, tmpl_neg, key_frames, vid_gif, vid_mp4, vid_webm, style_pos, style_neg],
+                               tmpl_pos, tmpl_neg, key_frames, vid_gif, vid_mp4, vid_webm, style_pos, style_neg,
+                               batch_size, variations, frame_format, frame_compression, stream_video, save_frames,
+                               gif_scale, gif_fps, gif_drop_duplicates, flow_smoothing],
                        outputs=[aa_gallery, aa_htmlinfo])
 
         btn_stop.click(fn=lambda: shared.state.interrupt())  # ,
@@ -419,14 +558,51 @@ def on_ui_settings():
                            shared.OptionInfo('C:/AI/frame_interpolation/film.bat',
                                              label="FILM batch or script file, including full path",
                                              section=mysection))
+    shared.opts.add_option("animatoranon_film_chunk",
+                           shared.OptionInfo(0,
+                                             label="Frames sent to FILM at a time while rendering, 0 to run FILM "
+                                                   "once rendering is done",
+                                             section=mysection))
     shared.opts.add_option("animatoranon_prop_folder",
                            shared.OptionInfo('c:/ai/props',
                                              label="Prop folder",
                                              section=mysection))
+    shared.opts.add_option("animatoranon_prop_cache_mb",
+                           shared.OptionInfo(prop_cache.DEFAULT_BUDGET_MB,
+                                             label="Memory for decoded props and stamps (MB)",
+                                             section=mysection))
+    shared.opts.add_option("animatoranon_source_cache",
+                           shared.OptionInfo('',
+                                             label="Folder to cache resized source images in, blank for no cache",
+                                             section=mysection))
+    shared.opts.add_option("animatoranon_source_cache_mb",
+                           shared.OptionInfo(sources.DEFAULT_CACHE_MB,
+                                             label="Size limit of the source image cache folder (MB)",
+                                             section=mysection))
     shared.opts.add_option("animatoranon_output_folder",
                            shared.OptionInfo('',
                                              label="New output folder",
                                              section=mysection))
+    shared.opts.add_option("animatoranon_writer_threads",
+                           shared.OptionInfo(2,
+                                             label="Number of threads used to compress and save frames in the "
+                                                   "background",
+                                             section=mysection))
+    shared.opts.add_option("animatoranon_raw_frames_png",
+                           shared.OptionInfo(False,
+                                             label="Also save raw format frames as png files at the end of a run",
+                                             section=mysection))
+    shared.opts.add_option("animatoranon_encoder_threads",
+                           shared.OptionInfo(0,
+                                             label="Number of threads shared by the ffmpeg video encoders, 0 for all "
+                                                   "cores",
+                                             section=mysection))
+    shared.opts.add_option("animatoranon_segment_devices",
+                           shared.OptionInfo('',
+                                             label="Segment devices for non-loopback mode, comma separated webui API "
+                                                   "urls (e.g. http://127.0.0.1:7861) or stub. Blank to render "
+                                                   "in this process",
+                                             section=mysection))
 
 
 script_callbacks.on_ui_tabs(on_ui_tabs)
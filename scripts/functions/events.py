@@ -0,0 +1,108 @@
+#
+# Keyframe events. Commands that happen at a point in time, rather than an interpolated value, are parsed once into
+# these by keyframe_functions, so the render loops don't need to re-parse the strings on every frame.
+# Kept free of webui imports so they can be handed to worker processes.
+#
+from PIL import ImageColor
+
+
+class KeyframeEvent:
+    __slots__ = ('frame_no',)
+
+    def __init__(self, frame_no: int):
+        self.frame_no = frame_no
+
+    def __repr__(self):
+        values = ', '.join(f"{s}={getattr(self, s)!r}" for cls in type(self).__mro__
+                           for s in getattr(cls, '__slots__', ()))
+        return f"{type(self).__name__}({values})"
+
+
+class ModelEvent(KeyframeEvent):
+    # time_s | model | model_name
+    __slots__ = ('model_name', 'checkpoint')
+
+    def __init__(self, frame_no: int, model_name: str, checkpoint):
+        super().__init__(frame_no)
+        self.model_name = model_name
+        self.checkpoint = checkpoint
+
+
+class ColourCorrectionEvent(KeyframeEvent):
+    # time_s | col_set
+    # time_s | col_clear
+    __slots__ = ('enabled',)
+
+    def __init__(self, frame_no: int, enabled: bool):
+        super().__init__(frame_no)
+        self.enabled = enabled
+
+
+class PropEvent(KeyframeEvent):
+    # time_s | prop | prop_filename | x_pos | y_pos | scale | rotation
+    __slots__ = ('filename', 'x', 'y', 'scale', 'rotation')
+
+    def __init__(self, frame_no: int, filename: str, x: int, y: int, scale: float, rotation: float):
+        super().__init__(frame_no)
+        self.filename = filename
+        self.x = x
+        self.y = y
+        self.scale = scale
+        self.rotation = rotation
+
+
+class StampEvent(PropEvent):
+    # time_s | set_stamp | stamp_name | stamp_filename | x_pos | y_pos | scale | rotation
+    __slots__ = ('name',)
+
+    def __init__(self, frame_no: int, name: str, filename: str, x: int, y: int, scale: float, rotation: float):
+        super().__init__(frame_no, filename, x, y, scale, rotation)
+        self.name = name
+
+
+class ClearStampEvent(KeyframeEvent):
+    # time_s | clear_stamp | stamp_name
+    __slots__ = ('name',)
+
+    def __init__(self, frame_no: int, name: str):
+        super().__init__(frame_no)
+        self.name = name
+
+
+class TextEvent(KeyframeEvent):
+    # time_s | set_text | textblock_name | text_prompt | x | y | w | h | back_color | fore_color | font_name
+    __slots__ = ('name', 'text', 'x', 'y', 'w', 'h', 'back_colour', 'fore_colour', 'font_name')
+
+    def __init__(self, frame_no: int, name: str, text: str, x: int, y: int, w: int, h: int,
+                 back_colour, fore_colour, font_name: str):
+        super().__init__(frame_no)
+        self.name = name
+        self.text = text
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self.back_colour = back_colour
+        self.fore_colour = fore_colour
+        self.font_name = font_name
+
+
+class ClearTextEvent(KeyframeEvent):
+    # time_s | clear_text | textblock_name
+    __slots__ = ('name',)
+
+    def __init__(self, frame_no: int, name: str):
+        super().__init__(frame_no)
+        self.name = name
+
+
+def parse_colour(colour: str):
+    # Colour as a tuple of bytes (127,0,127), or a name/hex string that PIL understands.
+    colour = colour.strip()
+    if colour.startswith('(') and colour.endswith(')'):
+        values = tuple(int(v) for v in colour[1:-1].split(',') if len(v.strip()) > 0)
+        if len(values) not in (3, 4) or any(v < 0 or v > 255 for v in values):
+            raise ValueError(f"colour tuple needs 3 or 4 values from 0 to 255: {colour}")
+        return values
+    ImageColor.getrgb(colour)  # Raises ValueError on unknown colours.
+    return colour
@@ -1,71 +1,119 @@
 import os
 import subprocess
 import glob
+import math
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
 from modules import shared
+from scripts.functions import frame_store, frame_writer
+
+# Folder in the output folder for frames interpolated by FILM while rendering.
+FILM_FRAMES_FOLDER = 'film_frames'
 
 
 def calc_FPS(mysettings: dict):
     '''
-        Frame rates.
+        Frame rate of the videos, so they last as long as the rendered frames at the animation fps.
         Smoothing:
-            FPS += smoothing_frames * (FPS - 1)
+            frames = rendered + smoothing_frames * (rendered - 1)
         FILM:
-        e.g. 10 + 9 + 18 + 36 + 72...
-            for i in range(smoothing_frames):
-                FPS += (FPS - 1)^i
+            Each pass puts a frame between every pair, so
+            frames = (rendered - 1) * 2^smoothing_frames + 1
+        final_fps = frames / (rendered / fps)
     '''
-    final_fps = 0
+    rendered = max(1, math.ceil(mysettings['fps'] * mysettings['total_time']))
     if mysettings['smoothing'] == 0:
-        final_fps = mysettings['fps']
+        frames = rendered
     elif mysettings['film_interpolation']:
-        final_fps = mysettings['fps']
-        added_frames = final_fps - 1
-        for i in range(mysettings['smoothing']):
-            final_fps += added_frames
-            added_frames *= 2
-        mysettings['final_fps'] = mysettings['fps']
+        frames = (rendered - 1) * 2 ** mysettings['smoothing'] + 1
     else:
-        final_fps = mysettings['fps'] + mysettings['smoothing'] * (mysettings['fps'] - 1)
+        frames = rendered + mysettings['smoothing'] * (rendered - 1)
 
-    mysettings['final_fps'] = final_fps
+    mysettings['total_frames'] = frames
+    mysettings['final_fps'] = frames * mysettings['fps'] / rendered
 
 
 def make_batch_files(my_set: dict):
-    #final_fps = my_set['fps'] + my_set['fps'] * my_set['smoothing']
     calc_FPS(my_set)
 
-    make_gif(my_set['output_path'], 'video', my_set['final_fps'], False, True)
-    make_mp4(my_set['output_path'], 'video', my_set['final_fps'], False, True)
-    make_webm(my_set['output_path'], 'video', my_set['final_fps'], False, True)
+    # After FILM the frames are png files, even if they were rendered into a frame store.
+    frame_format = my_set['frame_format']
+    if my_set['film_interpolation'] and frame_format == 'raw':
+        frame_format = 'png'
+    # FILM run while rendering puts its frames in their own folder.
+    frame_folder = FILM_FRAMES_FOLDER if my_set['film_chunk'] > 0 else ''
+    for video_format in ['gif', 'mp4', 'webm']:
+        make_video(video_format, my_set['output_path'], 'video', my_set['final_fps'], False, True, frame_format,
+                   filters=video_filter(my_set, video_format), size=(my_set['width'], my_set['height']),
+                   frame_folder=frame_folder)
     film_interpolation(my_set, False, True)
 
 
-def make_videos(my_set: dict):
-    if my_set['film_interpolation']:
+def make_videos(my_set: dict) -> list:
+    """
+    Make the checked video formats from the saved frames, and wait for them. Encodes run side by side within the
+    ffmpeg thread budget. Returns a result dict for each format, see run_encoder().
+    """
+    calc_FPS(my_set)
+    frame_format = my_set['frame_format']
+    frame_folder = ''
+    if len(glob.glob(os.path.join(my_set['output_path'], FILM_FRAMES_FOLDER, 'frame_*.png'))) > 0:
+        # Already interpolated while rendering.
+        frame_format = 'png'
+        frame_folder = FILM_FRAMES_FOLDER
+    elif my_set['film_interpolation']:
         film_interpolation(my_set)
-        final_fps = my_set['fps']
-        for i in range(my_set['smoothing']):
-            final_fps += final_fps - 1
-    else:
-        final_fps = my_set['fps'] + my_set['fps'] * my_set['smoothing']
-    make_gif(my_set['output_path'], 'video', final_fps, my_set['vid_gif'], False)
-    make_mp4(my_set['output_path'], 'video', final_fps, my_set['vid_mp4'], False)
-    make_webm(my_set['output_path'], 'video', final_fps, my_set['vid_webm'], False)
-
-
-def film_interpolation(my_set: dict, create_vid: bool = True, create_bat: bool = False):
-    # Need to do a bunch of stuff to copy the frames to the film folder, run that script and then copy them back.
-    # Check if FILM exists ...
-
+        frame_format = my_set['frame_format']
+
+    video_formats = [video_format for video_format in ['gif', 'mp4', 'webm'] if my_set[f'vid_{video_format}']]
+    if len(video_formats) == 0:
+        return []
+
+    # Settings from the UI can come back as floats, ffmpeg wants a whole number of threads.
+    budget = int(shared.opts.animatoranon_encoder_threads)
+    if budget <= 0:
+        budget = os.cpu_count() or 1
+    workers = max(1, min(len(video_formats), budget))
+    threads = max(1, budget // workers)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='animator_ffmpeg') as executor:
+        futures = [executor.submit(make_video, video_format, my_set['output_path'], 'video', my_set['final_fps'],
+                                   True, False, frame_format, threads, video_filter(my_set, video_format),
+                                   (my_set['width'], my_set['height']), frame_folder)
+                   for video_format in video_formats]
+        results = [future.result() for future in futures]
+
+    for result in results:
+        if result['returncode'] != 0:
+            print(f"Error making {result['filename']}: {result['error']}")
+    return results
+
+
+def film_command() -> tuple:
+    # FILM batch file and the folder it runs in, or None if it isn't set up.
     film_executable = os.path.basename(shared.opts.animatoranon_film_folder.strip())
     film_folder = os.path.dirname(shared.opts.animatoranon_film_folder.strip())
 
     if len(film_folder) == 0:
         print('No FILM folder set in options.')
-        return
+        return None, None
 
     if not os.path.exists(film_folder):
         print(f'FILM launching batch file could not be found in this folder: {film_folder}')
+        return None, None
+
+    return film_executable, film_folder
+
+
+def film_interpolation(my_set: dict, create_vid: bool = True, create_bat: bool = False):
+    # Need to do a bunch of stuff to copy the frames to the film folder, run that script and then copy them back.
+    # Check if FILM exists ...
+
+    film_executable, film_folder = film_command()
+    if film_folder is None:
         return
 
     # It shouldn't be necessary to look for this, the bat file is supposed to handle everything.
@@ -79,6 +127,14 @@ def film_interpolation(my_set: dict, create_vid: bool = True, create_bat: bool =
             str(my_set['smoothing']),
             ]
     if create_vid:
+        if my_set['frame_format'] == 'raw':
+            # FILM reads image files, hand the frames over as png and carry on with those.
+            store = frame_store.FrameStore.open(my_set['output_path'])
+            store.materialize(my_set['output_path'], 'png', my_set['frame_compression'],
+                              shared.opts.animatoranon_writer_threads)
+            store.close()
+            os.remove(store.filename)
+            my_set['frame_format'] = 'png'
         subprocess.call(args, cwd=film_folder, shell=True)
 
     if create_bat:
@@ -93,102 +149,268 @@ def film_interpolation(my_set: dict, create_vid: bool = True, create_bat: bool =
             return
 
         # Delete the files
-        filenames = glob.glob(os.path.join(my_set['output_path'], "*.png"))
+        frame_format = my_set['frame_format']
+        filenames = glob.glob(os.path.join(my_set['output_path'], f"*.{frame_format}"))
         for filename in filenames:
             os.remove(filename)
 
-        filenames = glob.glob(os.path.join(my_set['output_path'], 'interpolated_frames', '*.png'))
+        # FILM writes PNG, convert back to the frame format so the videos pick them up.
+        filenames = sorted(glob.glob(os.path.join(my_set['output_path'], 'interpolated_frames', '*.png')))
         i = 0
         for filename in filenames:
-            os.rename(filename, os.path.join(my_set['output_path'], f'frame_{i:05d}.png'))
+            new_filename = os.path.join(my_set['output_path'], f'frame_{i:05d}.{frame_format}')
+            if frame_format == 'png':
+                os.rename(filename, new_filename)
+            else:
+                with Image.open(filename) as img:
+                    frame_writer.save_frame(img, new_filename, frame_format, my_set['frame_compression'])
+                os.remove(filename)
             i += 1
 
 
-def make_gif(filepath: str, filename: str, fps: float, create_vid: bool, create_bat: bool):
+def gif_filter(my_set: dict) -> str:
+    """
+    ffmpeg filters for a small, quick GIF. The frame rate is capped, duplicate frames are dropped and the frames are
+    scaled down before a palette is made for the whole clip, which is then used to dither every frame.
+    The fps filter comes first, it fills gaps in the timestamps by repeating frames, which would bring back the ones
+    mpdecimate dropped. The GIF muxer keeps the gaps, the frame before a dropped one is just shown for longer.
+    """
+    filters = []
+    if 0 < my_set['gif_fps'] < my_set['final_fps']:
+        filters.append(f"fps={my_set['gif_fps']}")
+    if my_set['gif_drop_duplicates']:
+        filters.append('mpdecimate')
+    if my_set['gif_scale'] < 1:
+        filters.append(f"scale=trunc(iw*{my_set['gif_scale']}/2)*2:-2:flags=lanczos")
+    filters.append('split[a][b];[a]palettegen=stats_mode=diff[p];[b][p]paletteuse=dither=bayer:bayer_scale=5')
+    return ','.join(filters)
+
+
+def video_filter(my_set: dict, video_format: str) -> str:
+    # Extra ffmpeg filters for a video format, if any.
+    if video_format == 'gif':
+        return gif_filter(my_set)
+    return None
+
+
+def ffmpeg_cmd(video_format: str, fps: float, input_args: list, out_filename: str, threads: int = 0,
+               filters: str = None) -> list:
+    # Full ffmpeg command for one of the video formats, input_args say where the frames come from.
+    # threads limits the encoder, 0 leaves it to ffmpeg. filters replaces the GIF filters.
+    out_args = ['-threads', str(int(threads)), out_filename] if threads >= 1 else [out_filename]
+    if video_format == 'gif':
+        filter_args = ['-vf', filters] if filters else []
+        return ['ffmpeg', '-y', '-r', str(fps)] + input_args + filter_args + out_args
+    elif video_format == 'mp4':
+        return ['ffmpeg', '-y', '-r', str(fps)] + input_args + \
+            ['-c:v', 'libx264', '-vf', f'fps={fps}', '-pix_fmt', 'yuv420p', '-crf', '17', '-preset', 'veryfast'] + \
+            out_args
+    elif video_format == 'webm':
+        return ['ffmpeg', '-y', '-framerate', str(fps)] + input_args + \
+            ['-crf', str(50), '-preset', 'veryfast'] + out_args
+    raise ValueError(f"Unknown video format: {video_format}")
+
+
+def raw_input_args(width: int, height: int) -> list:
+    # ffmpeg input options for raw RGBA frames, as piped to a stream or kept in a frame store.
+    return ['-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', f"{int(width)}x{int(height)}"]
+
+
+def run_encoder(cmd: list) -> dict:
+    """
+    Run an ffmpeg command to the end. The result has the output filename, ffmpeg's return code (None if it couldn't
+    be started), how long it took in seconds and the end of its error output if it failed.
+    """
+    result = {'filename': cmd[-1], 'returncode': None, 'seconds': 0.0, 'error': ''}
+    start = time.perf_counter()
+    try:
+        completed = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        result['returncode'] = completed.returncode
+        if completed.returncode != 0:
+            result['error'] = completed.stderr.decode('utf-8', 'replace').strip()[-1000:]
+    except (OSError, IOError) as e:
+        result['error'] = "Error calling FFMPEG to render video. Is it installed and findable?"
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def make_video(video_format: str, filepath: str, filename: str, fps: float, create_vid: bool, create_bat: bool,
+               frame_format: str = 'png', threads: int = 0, filters: str = None, size: tuple = None,
+               frame_folder: str = '') -> dict:
     # Create filenames
-    in_filename = f"frame_%05d.png"
-    out_filename = f"{str(filename)}.gif"
-    # Build cmd for bat output, local file refs only
-    cmd = [
-        'ffmpeg',
-        '-y',
-        '-r', str(fps),
-        '-i', in_filename.replace("%", "%%"),
-        out_filename
-    ]
-    # create bat file
+    if frame_format == 'raw':
+        # All the frames are in the frame store file, size is needed to read it.
+        in_filename = os.path.join(frame_folder, frame_store.STORE_FILENAME)
+        in_args = raw_input_args(*size)
+    else:
+        in_filename = os.path.join(frame_folder, f"frame_%05d.{frame_format}")
+        in_args = []
+    out_filename = f"{str(filename)}.{video_format}"
+    # create bat file, local file refs only
     if create_bat:
-        with open(os.path.join(filepath, "makegif.bat"), "w+", encoding="utf-8") as f:
+        cmd = ffmpeg_cmd(video_format, fps, in_args + ['-i', in_filename.replace("%", "%%")], out_filename,
+                         filters=filters)
+        # Filter graphs need quoting on the command line.
+        cmd = [f'"{arg}"' if ';' in arg else arg for arg in cmd]
+        with open(os.path.join(filepath, f"make{video_format}.bat"), "w+", encoding="utf-8") as f:
             f.writelines([" ".join(cmd)])
             # f.writelines([" ".join(cmd), "\r\n", "pause"])
-    # Fix paths for normal output
-    cmd[5] = os.path.join(filepath, in_filename)
-    cmd[6] = os.path.join(filepath, out_filename)
-    # create output if requested
-    try:
-        if create_vid:
-            subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except (OSError, IOError) as e:
-        print("Error calling FFMPEG to render video. Is it installed and findable?")
+    # create output if requested, and wait for it
+    if create_vid:
+        return run_encoder(ffmpeg_cmd(video_format, fps, in_args + ['-i', os.path.join(filepath, in_filename)],
+                                      os.path.join(filepath, out_filename), threads, filters))
 
 
-def make_webm(filepath: str, filename: str, fps: float, create_vid: bool, create_bat: bool):
-    in_filename = f"frame_%05d.png"
-    out_filename = f"{str(filename)}.webm"
+def make_gif(filepath: str, filename: str, fps: float, create_vid: bool, create_bat: bool,
+             frame_format: str = 'png', filters: str = None) -> dict:
+    return make_video('gif', filepath, filename, fps, create_vid, create_bat, frame_format, filters=filters)
 
-    cmd = [
-        'ffmpeg',
-        '-y',
-        '-framerate', str(fps),
-        '-i', in_filename.replace("%", "%%"),
-        '-crf', str(50),
-        '-preset', 'veryfast',
-        out_filename
-    ]
 
-    if create_bat:
-        with open(os.path.join(filepath, "makewebm.bat"), "w+", encoding="utf-8") as f:
-            f.writelines([" ".join(cmd)])
-            # f.writelines([" ".join(cmd), "\r\n", "pause"])
+def make_webm(filepath: str, filename: str, fps: float, create_vid: bool, create_bat: bool,
+              frame_format: str = 'png') -> dict:
+    return make_video('webm', filepath, filename, fps, create_vid, create_bat, frame_format)
 
-    cmd[5] = os.path.join(filepath, in_filename)
-    cmd[10] = os.path.join(filepath, out_filename)
 
-    try:
-        if create_vid:
-            subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except (OSError, IOError) as e:
-        print("Error calling FFMPEG to render video. Is it installed and findable?")
-
-
-def make_mp4(filepath: str, filename: str, fps: float, create_vid: bool, create_bat: bool):
-    in_filename = f"frame_%05d.png"
-    out_filename = f"{str(filename)}.mp4"
-
-    cmd = [
-        'ffmpeg',
-        '-y',
-        '-r', str(fps),
-        '-i', in_filename.replace("%", "%%"),
-        '-c:v', 'libx264',
-        '-vf',
-        f'fps={fps}',
-        '-pix_fmt', 'yuv420p',
-        '-crf', '17',
-        '-preset', 'veryfast',
-        out_filename
-    ]
+def make_mp4(filepath: str, filename: str, fps: float, create_vid: bool, create_bat: bool,
+             frame_format: str = 'png') -> dict:
+    return make_video('mp4', filepath, filename, fps, create_vid, create_bat, frame_format)
 
-    if create_bat:
-        with open(os.path.join(filepath, "makemp4.bat"), "w+", encoding="utf-8") as f:
-            f.writelines([" ".join(cmd)])
-            # f.writelines([" ".join(cmd), "\r\n", "pause"])
 
-    cmd[5] = os.path.join(filepath, in_filename)
-    cmd[16] = os.path.join(filepath, out_filename)
+class VideoStream:
+    """
+    A video encoded while the animation renders. Raw RGBA frames are piped to ffmpeg as they are made, so the video
+    is finished moments after the last frame, without reading the frames back from disk. Closing the stream finishes
+    the video with whatever frames it has, so an interrupted run still leaves a playable video.
+    """
 
-    try:
-        if create_vid:
-            subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except (OSError, IOError) as e:
-        print("Error calling FFMPEG to render video. Is it installed and findable?")
+    def __init__(self, video_format: str, filepath: str, filename: str, fps: float, width: int, height: int,
+                 filters: str = None):
+        self.filename = os.path.join(filepath, f"{filename}.{video_format}")
+        self.size = (int(width), int(height))
+        self.frames = 0
+        self.result = None
+        self._error = None
+        self._start = time.perf_counter()
+        # ffmpeg reports progress on stderr, a file can't fill up and stall it like a pipe.
+        self._log = tempfile.TemporaryFile()
+        input_args = raw_input_args(*self.size) + ['-i', '-']
+        self._process = subprocess.Popen(ffmpeg_cmd(video_format, fps, input_args, self.filename, filters=filters),
+                                         stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self._log)
+
+    def write(self, data: bytes):
+        if self._error is not None:
+            return
+        try:
+            self._process.stdin.write(data)
+            self.frames += 1
+        except (OSError, IOError) as e:
+            self._error = e
+
+    def close(self) -> int:
+        if self._process.stdin.closed:
+            return self._process.returncode
+        if self.frames == 0:
+            # Nothing was rendered through this stream, don't leave a broken file behind.
+            self._process.kill()
+            self._process.wait()
+            self._process.stdin.close()
+            self._log.close()
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            return None
+        try:
+            self._process.stdin.close()
+        except (OSError, IOError) as e:
+            self._error = self._error or e
+        returncode = self._process.wait()
+        # Same as run_encoder(), the time covers the whole render.
+        self.result = {'filename': self.filename, 'returncode': returncode,
+                       'seconds': time.perf_counter() - self._start, 'error': ''}
+        if returncode != 0 or self._error is not None:
+            self._log.seek(0)
+            self.result['error'] = self._log.read().decode('utf-8', 'replace').strip()[-1000:]
+            print(f"Error streaming {self.filename}: {self.result['error']}")
+        self._log.close()
+        return returncode
+
+
+def open_streams(my_set: dict) -> list:
+    # Video streams for the formats that were checked, for frames saved in this output folder.
+    streams = []
+    for video_format in ['gif', 'mp4', 'webm']:
+        if my_set[f'vid_{video_format}']:
+            try:
+                streams.append(VideoStream(video_format, my_set['output_path'], 'video', my_set['final_fps'],
+                                           my_set['width'], my_set['height'], video_filter(my_set, video_format)))
+            except (OSError, IOError) as e:
+                print("Error calling FFMPEG to render video. Is it installed and findable?")
+    return streams
+
+
+class FilmWorker:
+    """
+    Runs FILM on chunks of frames in the background while rendering carries on. Takes raw RGBA frames like a
+    VideoStream. Each chunk starts with the last frame of the one before so the gap between them gets filled in too,
+    and the results are added in order to a separate sequence of frames, see FILM_FRAMES_FOLDER.
+    """
+
+    def __init__(self, output_path: str, chunk_size: int, smoothing: int, width: int, height: int):
+        self.output_path = output_path
+        self.chunk_size = max(2, int(chunk_size))
+        self.smoothing = smoothing
+        self.size = (int(width), int(height))
+        self.frames = 0
+        self._chunk = []
+        self._last = None
+        self._chunks = 0
+        self._saved = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='animator_film')
+        self._futures = []
+        os.makedirs(os.path.join(output_path, FILM_FRAMES_FOLDER), exist_ok=True)
+
+    def write(self, data: bytes):
+        self._chunk.append(data)
+        self.frames += 1
+        if len(self._chunk) >= self.chunk_size:
+            self._submit()
+
+    def _submit(self):
+        if len(self._chunk) == 0:
+            return
+        frames = self._chunk if self._last is None else [self._last] + self._chunk
+        self._futures.append(self._executor.submit(self._interpolate, self._chunks, frames, self._last is not None))
+        self._last = self._chunk[-1]
+        self._chunk = []
+        self._chunks += 1
+
+    def _interpolate(self, chunk_no: int, frames: list, overlap: bool):
+        chunk_folder = os.path.join(self.output_path, 'film_chunks', f"chunk_{chunk_no:04}")
+        os.makedirs(chunk_folder, exist_ok=True)
+        for i, data in enumerate(frames):
+            Image.frombytes('RGBA', self.size, data).save(os.path.join(chunk_folder, f"frame_{i:05}.png"))
+
+        film_executable, film_folder = film_command()
+        if film_folder is not None:
+            subprocess.call([film_executable, chunk_folder, str(self.smoothing)], cwd=film_folder, shell=True)
+        filenames = sorted(glob.glob(os.path.join(chunk_folder, 'interpolated_frames', '*.png')))
+        if len(filenames) == 0:
+            # Keep the sequence going without the in between frames.
+            print(f"FILM failed to produce a result for chunk {chunk_no}.")
+            filenames = sorted(glob.glob(os.path.join(chunk_folder, 'frame_*.png')))
+
+        # The first frame came with the chunk before.
+        for filename in filenames[1:] if overlap else filenames:
+            os.replace(filename, os.path.join(self.output_path, FILM_FRAMES_FOLDER, f"frame_{self._saved:05}.png"))
+            self._saved += 1
+        shutil.rmtree(chunk_folder, ignore_errors=True)
+
+    def close(self):
+        # Send the last partial chunk and wait for FILM to finish everything.
+        self._submit()
+        self._executor.shutdown()
+        for future in self._futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error running FILM on a chunk of frames: {e}")
+        shutil.rmtree(os.path.join(self.output_path, 'film_chunks'), ignore_errors=True)
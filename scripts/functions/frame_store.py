@@ -0,0 +1,115 @@
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+from scripts.functions import frame_writer
+
+STORE_FILENAME = 'frames.raw'
+INDEX_FILENAME = 'frames.json'
+
+
+class FrameStore:
+    """
+    Frames kept in one memory mapped file of raw RGBA pixels instead of an image file each. Nothing is encoded or
+    decoded, frames are read back as NumPy views straight onto the file, and ffmpeg can read the file as is.
+    Frame n is at slot n, the same number it would have as a file. The index next to it holds the frame size and how
+    many frames at the start are complete.
+    Several processes can write to the same store, as long as it was created big enough for all of them.
+    """
+
+    def __init__(self, path: str, width: int, height: int, capacity: int = 0, count: int = 0):
+        self.path = path
+        self.width = int(width)
+        self.height = int(height)
+        self.count = count
+        self._frames = None
+        self._map(max(1, capacity), 'r+' if os.path.exists(self.filename) else 'w+')
+
+    @classmethod
+    def create(cls, path: str, width: int, height: int, capacity: int):
+        # New store for a render, sized for the expected number of frames up front.
+        if os.path.exists(os.path.join(path, STORE_FILENAME)):
+            os.remove(os.path.join(path, STORE_FILENAME))
+        store = cls(path, width, height, capacity)
+        store.write_index()
+        return store
+
+    @classmethod
+    def open(cls, path: str):
+        with open(os.path.join(path, INDEX_FILENAME), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        frame_bytes = index['width'] * index['height'] * 4
+        capacity = os.path.getsize(os.path.join(path, STORE_FILENAME)) // frame_bytes
+        return cls(path, index['width'], index['height'], capacity, index['count'])
+
+    @property
+    def filename(self) -> str:
+        return os.path.join(self.path, STORE_FILENAME)
+
+    @property
+    def size(self) -> tuple:
+        return self.width, self.height
+
+    @property
+    def capacity(self) -> int:
+        return len(self._frames)
+
+    def _map(self, capacity: int, mode: str):
+        self._frames = np.memmap(self.filename, dtype=np.uint8, mode=mode, shape=(capacity, self.height, self.width, 4))
+
+    def _grow(self, capacity: int):
+        # More frames than expected, e.g. the source ran longer. Extend the file and map it again.
+        capacity = max(capacity, self.capacity * 2)
+        self._frames.flush()
+        self._frames = None
+        self._map(capacity, 'r+')
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        # Zero copy (height, width, 4) view of a frame, only valid while the store is open.
+        if not 0 <= index < self.count:
+            raise IndexError(f"Frame {index} is not in the store.")
+        return self._frames[index]
+
+    def image(self, index: int) -> Image:
+        # Frame as a PIL image sharing the store's memory.
+        return Image.frombuffer('RGBA', self.size, self[index], 'raw', 'RGBA', 0, 1)
+
+    def write(self, index: int, image: Image):
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        if image.size != self.size:
+            image = image.resize(self.size, Image.Resampling.LANCZOS)
+        if index >= self.capacity:
+            self._grow(index + 1)
+        self._frames[index] = np.asarray(image)
+        self.count = max(self.count, index + 1)
+
+    def flush(self):
+        self._frames.flush()
+
+    def write_index(self):
+        with open(os.path.join(self.path, INDEX_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump({'width': self.width, 'height': self.height, 'count': self.count}, f)
+
+    def close(self):
+        # Cut the file down to the frames that were made, so it can be read as a plain raw video.
+        if self._frames is None:
+            return
+        self._frames.flush()
+        self._frames = None
+        with open(self.filename, 'r+b') as f:
+            f.truncate(self.count * self.width * self.height * 4)
+        self.write_index()
+
+    def materialize(self, output_path: str, frame_format: str = 'png', compress_level: int = 6, threads: int = 2):
+        # Save the frames as numbered image files, e.g. for FILM or to keep them.
+        with frame_writer.FrameWriter(threads, compress_level=compress_level) as writer:
+            for index in range(self.count):
+                # Copied, the writer encodes in the background and the store may be closed before it is done.
+                writer.save(Image.fromarray(np.array(self[index])),
+                            os.path.join(output_path, f"frame_{index:05}.{frame_format}"))
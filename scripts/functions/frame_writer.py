@@ -0,0 +1,162 @@
+import io
+import os
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+# Intermediate frame formats, by file extension.
+#   png:  lossless, compress level 0 (fastest, largest) to 9 (slowest, smallest).
+#   webp: lossless, the compress level sets how hard the encoder tries. Usually much smaller than PNG.
+#   jpg:  high quality lossy, no alpha. Fast to encode and small.
+#   bmp:  uncompressed, no encoding cost but large on disk.
+#   raw:  uncompressed, all frames in one memory mapped file instead of a file each, see frame_store.
+FRAME_FORMATS = ['png', 'webp', 'jpg', 'bmp', 'raw']
+
+# Formats FILM can read. Frames in a frame store are saved as png for it.
+FILM_FORMATS = ['png', 'jpg']
+
+
+def save_options(extension: str, compress_level: int) -> dict:
+    compress_level = max(0, min(9, int(compress_level)))
+    if extension == 'png':
+        return {'compress_level': compress_level}
+    elif extension == 'webp':
+        return {'lossless': True, 'quality': round(compress_level * 100 / 9), 'method': round(compress_level * 6 / 9)}
+    elif extension == 'jpg':
+        return {'quality': 95, 'subsampling': 0}
+    return {}
+
+
+def save_frame(image: Image, fp, extension: str, compress_level: int = 6):
+    # Save to a filename or file object in one of the frame formats.
+    if extension not in FRAME_FORMATS or extension == 'raw':
+        raise ValueError(f"Unknown frame format: {extension}")
+    if extension == 'jpg' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.save(fp, format=Image.registered_extensions()['.' + extension], **save_options(extension, compress_level))
+
+
+class FrameWriter:
+    """
+    Saves frames in the background so PNG compression doesn't hold up the render loop.
+    Frames are encoded on a small thread pool, and written to disk by a single thread in the order they were handed
+    over, so files always appear in sequence. The queue is bounded: when the disk can't keep up, save() blocks until
+    there is room. A failed write is raised back in the render loop on the next save(), flush() or close().
+    Images must not be modified after they are handed over.
+
+    Animation frames can also be piped to video streams, keyed by the folder the frame is saved in. Writing the frame
+    files can then be turned off, debug images are always written. Frames for a folder with a frame store go in the
+    store rather than in files, at the number in their filename.
+    """
+
+    def __init__(self, threads: int = 2, queue_size: int = 0, compress_level: int = 6, streams: dict = None,
+                 save_frames: bool = True, stores: dict = None):
+        threads = max(1, int(threads))
+        self.compress_level = compress_level
+        self.streams = {os.path.normpath(path): s for path, s in (streams or {}).items()}
+        self.stores = {os.path.normpath(path): s for path, s in (stores or {}).items()}
+        self.save_frames = save_frames
+        self._encoders = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='animator_encode')
+        self._queue = queue.Queue(maxsize=queue_size if queue_size > 0 else threads * 4)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_loop, name='animator_writer', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Don't mask an exception from the render loop with a write error.
+        self.close(raise_errors=exc_type is None)
+
+    def _encode(self, image: Image, filename: str, save: bool, streams: list, store) -> tuple:
+        data = None
+        if save and store is None:
+            buffer = io.BytesIO()
+            save_frame(image, buffer, os.path.splitext(filename)[1].lower().lstrip('.'), self.compress_level)
+            data = buffer.getvalue()
+        pixels = None
+        if len(streams) > 0 or (save and store is not None):
+            # Raw pixels at the video size.
+            size = store.size if store is not None else streams[0].size
+            if image.mode != 'RGBA':
+                image = image.convert('RGBA')
+            if image.size != size:
+                image = image.resize(size, Image.Resampling.LANCZOS)
+            pixels = image
+        return data, pixels
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                future, filename, save, streams, store = item
+                if self._error is None:
+                    data, pixels = future.result()
+                    if data is not None:
+                        with open(filename, 'wb') as f:
+                            f.write(data)
+                    if save and store is not None:
+                        store.write(int(re.match(r'frame_(\d+)', os.path.basename(filename)).group(1)), pixels)
+                    if len(streams) > 0:
+                        raw = pixels.tobytes()
+                        for stream in streams:
+                            stream.write(raw)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _submit(self, image: Image, filename: str, save: bool, streams: list, store=None):
+        self._raise_error()
+        if self._closed:
+            raise RuntimeError("Frame writer has been closed.")
+        if save or len(streams) > 0:
+            self._queue.put((self._encoders.submit(self._encode, image, filename, save, streams, store), filename,
+                             save, streams, store))
+
+    def save(self, image: Image, filename: str):
+        # Debug and other images that are always written to disk, as png if frames are going in a frame store.
+        if filename.endswith('.raw'):
+            filename = filename[:-len('.raw')] + '.png'
+        self._submit(image, filename, True, [])
+
+    def frame(self, image: Image, filename: str):
+        # A frame of the animation, goes into the videos for its folder.
+        folder = os.path.normpath(os.path.dirname(filename))
+        self._submit(image, filename, self.save_frames, self.streams.get(folder, []), self.stores.get(folder))
+
+    def store(self, path: str):
+        # Frame store for a folder, if frames there are going in one.
+        return self.stores.get(os.path.normpath(path))
+
+    def flush(self):
+        # Wait for everything handed over so far to be on disk.
+        self._queue.join()
+        self._raise_error()
+
+    def close(self, raise_errors: bool = True):
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+            self._encoders.shutdown()
+            # Finish the videos, with whatever frames made it if rendering stopped early.
+            for streams in self.streams.values():
+                for stream in streams:
+                    stream.close()
+            for store in self.stores.values():
+                store.close()
+        if raise_errors:
+            self._raise_error()
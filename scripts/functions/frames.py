@@ -0,0 +1,28 @@
+#
+# Frames as NumPy arrays.
+# Between webui calls a frame is kept as one contiguous (height, width, 4) uint8 RGBA array, so the pre- and post-
+# processing steps work on the same buffer instead of converting to and from PIL images at every step. Frames only
+# become PIL images where webui or the frame writer need one, and then share the array's memory.
+#
+import numpy as np
+from PIL import Image
+
+
+def to_array(frame) -> np.ndarray:
+    # RGBA array of an image or array. Arrays are passed through, images copied once, read only.
+    if isinstance(frame, np.ndarray):
+        return frame
+    if frame.mode != 'RGBA':
+        frame = frame.convert('RGBA')
+    return np.asarray(frame)
+
+
+def writable(frame: np.ndarray) -> np.ndarray:
+    # The array itself if it can be changed in place, otherwise a copy.
+    return frame if frame.flags.writeable else frame.copy()
+
+
+def to_image(frame: np.ndarray) -> Image:
+    # RGBA image sharing the array's memory, the array must not be changed after this.
+    frame = np.ascontiguousarray(frame)
+    return Image.frombuffer('RGBA', (frame.shape[1], frame.shape[0]), frame, 'raw', 'RGBA', 0, 1)
@@ -0,0 +1,75 @@
+import numpy as np
+from scipy.interpolate import make_interp_spline
+
+# Interpolation modes for a keyframe track.
+#   linear: straight lines between anchors, held flat before the first and after the last anchor.
+#   spline: quadratic spline through the anchors, held flat outside them.
+#   step:   hold each anchor value until the next one (forward fill).
+#   auto:   spline when there are more than 3 anchors, otherwise linear. This is what the old dataframe did.
+INTERPOLATION_MODES = ['auto', 'linear', 'spline', 'step']
+
+
+class KeyframeTrack:
+    """
+    A single animated parameter, stored as its keyframe anchors only. Values for any range of frames are
+    calculated on demand, so the timeline length does not matter until something is actually evaluated.
+    """
+
+    def __init__(self, mode: str = 'auto'):
+        if mode not in INTERPOLATION_MODES:
+            raise ValueError(f"Unknown interpolation mode: {mode}")
+        self.mode = mode
+        self.anchors = {}
+        self._compiled = None
+
+    def __len__(self):
+        return len(self.anchors)
+
+    def __setitem__(self, frame_no: int, value):
+        # Later keyframes on the same frame overwrite earlier ones.
+        self.anchors[int(frame_no)] = value
+        self._compiled = None
+
+    def _compile(self):
+        if self._compiled is None:
+            frames = np.array(sorted(self.anchors), dtype=np.int64)
+            values = [self.anchors[f] for f in frames]
+            mode = self.mode
+            if mode == 'auto':
+                mode = 'spline' if len(frames) > 3 else 'linear'
+            if mode == 'spline' and len(frames) < 3:
+                mode = 'linear'
+
+            spline = None
+            if mode != 'step':
+                values = np.array(values, dtype=np.float64)
+                if mode == 'spline':
+                    spline = make_interp_spline(frames, values, k=2)
+            self._compiled = (mode, frames, values, spline)
+        return self._compiled
+
+    def indices(self, start: int, stop: int) -> np.ndarray:
+        """
+        Index of the anchor in effect for each frame in [start, stop), i.e. the last anchor at or before the frame.
+        Frames before the first anchor use the first one.
+        """
+        _, frames, _, _ = self._compile()
+        idx = np.searchsorted(frames, np.arange(start, stop), side='right') - 1
+        return np.clip(idx, 0, len(frames) - 1)
+
+    def values(self, start: int, stop: int, dtype=np.float64) -> np.ndarray:
+        if len(self.anchors) == 0:
+            raise ValueError("Cannot evaluate a keyframe track without any anchors.")
+        mode, frames, values, spline = self._compile()
+        if mode == 'step':
+            return np.array(values, dtype=dtype)[self.indices(start, stop)]
+
+        x = np.arange(start, stop)
+        result = np.interp(x, frames, values)
+        if spline is not None:
+            inside = (x >= frames[0]) & (x <= frames[-1])
+            result[inside] = spline(x[inside])
+        return result.astype(dtype, copy=False)
+
+    def value(self, frame_no: int):
+        return self.values(frame_no, frame_no + 1)[0]
@@ -1,8 +1,7 @@
-import glob
 import math
 import os
 import random
-from typing import Tuple
+from typing import Optional, Tuple
 
 import numpy as np
 import pandas as pd
@@ -10,7 +9,10 @@ import piexif
 import piexif.helper
 from PIL import Image
 
-from modules import shared
+from modules import shared, sd_models
+from scripts.functions import interpolation, sources
+from scripts.functions.events import KeyframeEvent, ModelEvent, ColourCorrectionEvent, PropEvent, StampEvent, \
+    ClearStampEvent, TextEvent, ClearTextEvent, parse_colour
 
 
 def read_vtt(filepath: str, total_time: float, fps: float) -> list:
@@ -110,39 +112,106 @@ def get_pnginfo(filepath: str) -> Tuple[bool, str, str]:
     return worked, geninfo, info
 
 
-# Process the keyframe string and build the dataframe of all the changing parameters
-def process_keyframes(mysettings: dict) -> pd.DataFrame:
-    mysettings['keyframes'] = {}  # Dict of keyframes, where the index will be the frame it takes effect.
+# Numeric parameters that can be set by keyframes, and the value they start with on frame 0.
+NUMERIC_PARAMETERS = ['denoise', 'x_shift', 'y_shift', 'zoom', 'rotation', 'noise', 'cfg_scale',
+                      'px0', 'py0', 'px1', 'py1', 'px2', 'py2', 'px3', 'py3', 'punsharpen']
+PERSPECTIVE_PARAMETERS = ['px0', 'py0', 'px1', 'py1', 'px2', 'py2', 'px3', 'py3']
+
+
+# Number of fields after the time for each event command, including the command itself.
+EVENT_COMMAND_LENGTHS = {'model': 2, 'col_set': 1, 'col_clear': 1, 'prop': 6, 'set_stamp': 7, 'clear_stamp': 2,
+                         'set_text': 10, 'clear_text': 2}
+
+
+def parse_event(frame_no: int, parts: list) -> Optional[KeyframeEvent]:
+    """
+    Parse the fields of a keyframe (after the time) into an event. Returns None if it isn't an event command, raises
+    ValueError if it is one but is malformed.
+    """
+    command = parts[0].lower().strip()
+    if command not in EVENT_COMMAND_LENGTHS:
+        return None
+    if len(parts) != EVENT_COMMAND_LENGTHS[command]:
+        raise ValueError(f"{command} expects {EVENT_COMMAND_LENGTHS[command] - 1} values, got {len(parts) - 1}")
+
+    if command == "model":
+        model_name = parts[1].strip()
+        checkpoint = sd_models.get_closet_checkpoint_match(model_name + ".ckpt")
+        if checkpoint is None:
+            raise ValueError(f"Unknown checkpoint: {model_name}")
+        return ModelEvent(frame_no, model_name, checkpoint)
+    elif command == "col_set":
+        return ColourCorrectionEvent(frame_no, True)
+    elif command == "col_clear":
+        return ColourCorrectionEvent(frame_no, False)
+    elif command == "prop":
+        return PropEvent(frame_no, parts[1].strip(), int(parts[2]), int(parts[3]), float(parts[4]),
+                         float(parts[5]))
+    elif command == "set_stamp":
+        return StampEvent(frame_no, parts[1].strip(), parts[2].strip(), int(parts[3]), int(parts[4]),
+                          float(parts[5]), float(parts[6]))
+    elif command == "clear_stamp":
+        return ClearStampEvent(frame_no, parts[1].strip())
+    elif command == "set_text":
+        return TextEvent(frame_no, parts[1].strip(), parts[2].strip().replace('\\n', '\n'),
+                         int(parts[3]), int(parts[4]), int(parts[5]), int(parts[6]),
+                         parse_colour(parts[7]), parse_colour(parts[8]), parts[9].strip().lower())
+    else:
+        return ClearTextEvent(frame_no, parts[1].strip())
+
+
+class KeyframeTimeline:
+    """
+    All the changing parameters of an animation, held as keyframe anchors. Values are interpolated on demand,
+    see compile_schedule() to get flat per frame arrays.
+    """
+
+    def __init__(self, frame_count: int):
+        # Frames 0 to frame_count inclusive, same as the rows of the old dataframe.
+        self.frame_count = frame_count
+        self.tracks = {name: interpolation.KeyframeTrack('auto') for name in NUMERIC_PARAMETERS}
+        # Prompts are (pos1, neg1, pos2, neg2) segments, blended by the weight track.
+        self.prompt_segments = []
+        self.prompt_segment = interpolation.KeyframeTrack('step')
+        self.prompt_weight = interpolation.KeyframeTrack('linear')
+        # seed_end is None when sub-seeds are disabled.
+        self.seed_start = interpolation.KeyframeTrack('linear')
+        self.seed_end = None
+        self.seed_str = interpolation.KeyframeTrack('linear')
+        # Point in time commands, sorted by frame.
+        self.events = []
+
+    def anchors_frame(self) -> pd.DataFrame:
+        # Sparse table of the keyframe anchors, for the csv dump.
+        columns = {name: pd.Series(track.anchors, dtype=float) for name, track in self.tracks.items()}
+        columns['prompt'] = pd.Series(self.prompt_weight.anchors, dtype=float)
+        columns['prompt_segment'] = pd.Series(self.prompt_segment.anchors, dtype=float)
+        columns['seed_start'] = pd.Series(self.seed_start.anchors, dtype=float)
+        if self.seed_end is not None:
+            columns['seed_end'] = pd.Series(self.seed_end.anchors, dtype=float)
+        columns['seed_str'] = pd.Series(self.seed_str.anchors, dtype=float)
+        return pd.DataFrame(columns).sort_index()
+
+
+# Process the keyframe string and build the timeline of all the changing parameters
+def process_keyframes(mysettings: dict) -> KeyframeTimeline:
     mysettings['debug'] = False
     my_prompts = []  # List of tuple of prompts
     my_seeds = {}  # dict of seeds
+    bad_keyframes = []  # Malformed event commands, reported before anything is rendered.
 
     frame_count = math.ceil(mysettings['fps'] * mysettings['total_time'])
 
-    # Define the columns in the pandas dataframe that will hold and calculate all the changing values..
-    variables = {'pos1': np.nan,
-                 'neg1': np.nan,
-                 'pos2': np.nan,
-                 'neg2': np.nan,
-                 'prompt': np.nan,
-                 'denoise': np.nan,
-                 'noise': np.nan,
-                 'x_shift': np.nan,
-                 'y_shift': np.nan,
-                 'zoom': np.nan,
-                 'rotation': np.nan,
-                 'cfg_scale': np.nan}
-
-    # Create the dataframe
-    df = pd.DataFrame(variables, index=range(frame_count + 1))
-
-    # Preload the dataframe with some values, so they can be filled down correctly.
-    df.loc[0, ['denoise', 'x_shift', 'y_shift', 'zoom', 'rotation', 'noise', 'cfg_scale',
-               'px0', 'py0', 'px1', 'py1', 'px2', 'py2', 'px3', 'py3', 'punsharpen']] = \
-        [mysettings['denoising_strength'],
-         0.0, 0.0, 1.0, 0.0,
-         mysettings['noise_strength'],
-         mysettings['cfg_scale'], 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+    timeline = KeyframeTimeline(frame_count)
+    tracks = timeline.tracks
+
+    # Preload the timeline with some values, so they can be filled down correctly.
+    for name, value in zip(NUMERIC_PARAMETERS,
+                           [mysettings['denoising_strength'],
+                            0.0, 0.0, 1.0, 0.0,
+                            mysettings['noise_strength'],
+                            mysettings['cfg_scale'], 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]):
+        tracks[name][0] = value
 
     # Iterate through the supplied keyframes, splitting by newline.
     for key_frame in mysettings['key_frames'].splitlines():
@@ -160,44 +229,38 @@ def process_keyframes(mysettings: dict) -> pd.DataFrame:
         tmp_frame_no = int(float(key_frame_parts[0]) * mysettings['fps'])
         tmp_command = key_frame_parts[1].lower().strip()
 
-        if tmp_frame_no not in mysettings['keyframes']:
-            mysettings['keyframes'][tmp_frame_no] = []
-        mysettings['keyframes'][tmp_frame_no].append(key_frame_parts[1:])
+        try:
+            event = parse_event(tmp_frame_no, key_frame_parts[1:])
+        except ValueError as e:
+            bad_keyframes.append(f"{key_frame.strip()}: {e}")
+            continue
+        if event is not None:
+            timeline.events.append(event)
+            continue
 
-        # Switch on command and load in the appropriate data into the dataframe
+        # Switch on command and load in the appropriate anchors into the timeline
         if tmp_command == "transform" and len(key_frame_parts) == 6:
             # Time (s) | transform  | Zoom (/s) | X Shift (pix/s) | Y shift (pix/s) | Rotation (deg/s)
-            df.loc[tmp_frame_no,
-                   ['x_shift', 'y_shift', 'zoom', 'rotation']
-            ] = [float(key_frame_parts[3]) / mysettings['fps'],
-                 float(key_frame_parts[4]) / mysettings['fps'],
-                 float(key_frame_parts[2]) ** (1.0 / mysettings['fps']),
-                 float(key_frame_parts[5]) / mysettings['fps']]
+            tracks['x_shift'][tmp_frame_no] = float(key_frame_parts[3]) / mysettings['fps']
+            tracks['y_shift'][tmp_frame_no] = float(key_frame_parts[4]) / mysettings['fps']
+            tracks['zoom'][tmp_frame_no] = float(key_frame_parts[2]) ** (1.0 / mysettings['fps'])
+            tracks['rotation'][tmp_frame_no] = float(key_frame_parts[5]) / mysettings['fps']
         elif tmp_command == "debug" and len(key_frame_parts) == 3:
             # Time (s) | debug | boolean
             mysettings['debug'] = True
         elif tmp_command == "perspective" and len(key_frame_parts) == 11:
             # time_s | perspective | x0 | y0 | x1 | y1 | x2 | y2 | x3 | y3 | unsharpen
-            df.loc[tmp_frame_no,
-                   ['px0', 'py0', 'px1', 'py1', 'px2', 'py2', 'px3', 'py3', 'punsharpen']
-            ] = [float(key_frame_parts[2]),
-                 float(key_frame_parts[3]),
-                 float(key_frame_parts[4]),
-                 float(key_frame_parts[5]),
-                 float(key_frame_parts[6]),
-                 float(key_frame_parts[7]),
-                 float(key_frame_parts[8]),
-                 float(key_frame_parts[9]),
-                 float(key_frame_parts[10])]
+            for name, value in zip(PERSPECTIVE_PARAMETERS + ['punsharpen'], key_frame_parts[2:11]):
+                tracks[name][tmp_frame_no] = float(value)
         elif tmp_command == "denoise" and len(key_frame_parts) == 3:
             # Time (s) | denoise | denoise
-            df.loc[tmp_frame_no, ['denoise']] = [float(key_frame_parts[2])]
+            tracks['denoise'][tmp_frame_no] = float(key_frame_parts[2])
         elif tmp_command == "cfg_scale" and len(key_frame_parts) == 3:
             # Time (s) | cfg_scale | cfg_scale
-            df.loc[tmp_frame_no, ['cfg_scale']] = [float(key_frame_parts[2])]
+            tracks['cfg_scale'][tmp_frame_no] = float(key_frame_parts[2])
         elif tmp_command == "noise" and len(key_frame_parts) == 3:
             # Time (s) | noise | noise_strength
-            df.loc[tmp_frame_no, ['noise']] = [float(key_frame_parts[2])]
+            tracks['noise'][tmp_frame_no] = float(key_frame_parts[2])
         elif tmp_command == "seed" and len(key_frame_parts) == 3:
             # Time (s) | seed | seed
             my_seeds[tmp_frame_no] = int(key_frame_parts[2])
@@ -254,7 +317,8 @@ def process_keyframes(mysettings: dict) -> pd.DataFrame:
                 else:
                     print(f"Could not locate video: {tmp_source_path}")
             elif tmp_source_name == 'images':
-                source_cap = glob.glob(tmp_source_path)
+                # In natural order, frame_2 before frame_10.
+                source_cap = sources.image_files(tmp_source_path)
                 if len(source_cap) > 0:
                     mysettings['source'] = tmp_source_name
                     mysettings['source_file'] = source_cap
@@ -262,6 +326,11 @@ def process_keyframes(mysettings: dict) -> pd.DataFrame:
                 else:
                     print(f'No images found, reverting back to img2img: {tmp_source_path}')
 
+    if len(bad_keyframes) > 0:
+        raise RuntimeError("Malformed keyframes:\n" + "\n".join(bad_keyframes))
+    # Stable sort, so events on the same frame keep the order they were written in.
+    timeline.events.sort(key=lambda e: e.frame_no)
+
     #
     # Prompts
     #
@@ -275,40 +344,38 @@ def process_keyframes(mysettings: dict) -> pd.DataFrame:
     except Exception as e:
         print(f"Error: Failed to apply styles to templates: {e}")
 
-    # Sort the dict of prompts by frame number, and then populate the dataframe in a alternating fashion.
+    # Sort the dict of prompts by frame number, and then populate the timeline in a alternating fashion.
     # need to do this to ensure the prompts flow onto each other correctly.
     my_prompts = sorted(my_prompts)
     if mysettings['debug']:
         print("DBG prompts:")
         print(my_prompts)
 
+    segments = timeline.prompt_segments
     # Special case if no prompts supplied.
     if len(my_prompts) == 0:
-        df.loc[0, ['pos1', 'neg1', 'pos2', 'neg2', 'prompt']] = ["", "", "", "", 1.0]
+        segments.append(("", "", "", ""))
+        timeline.prompt_segment[0] = 0
+        timeline.prompt_weight[0] = 1.0
     elif len(my_prompts) == 1:
-        df.loc[0, ['pos1', 'neg1', 'pos2', 'neg2', 'prompt']] = [my_prompts[0][1], my_prompts[0][2], "", "", 1.0]
+        segments.append((my_prompts[0][1], my_prompts[0][2], "", ""))
+        timeline.prompt_segment[0] = 0
+        timeline.prompt_weight[0] = 1.0
     else:
         for x in range(len(my_prompts)):
             if x < len(my_prompts) - 1:
-                df.loc[my_prompts[x][0], ['pos1', 'neg1', 'pos2', 'neg2', 'prompt']] = [my_prompts[x][1],
-                                                                                        my_prompts[x][2],
-                                                                                        my_prompts[x + 1][1],
-                                                                                        my_prompts[x + 1][2],
-                                                                                        1]
+                segments.append((my_prompts[x][1], my_prompts[x][2], my_prompts[x + 1][1], my_prompts[x + 1][2]))
             else:
-                df.loc[my_prompts[x][0], ['pos1', 'neg1', 'pos2', 'neg2', 'prompt']] = [my_prompts[x][1],
-                                                                                        my_prompts[x][2],
-                                                                                        my_prompts[x][1],
-                                                                                        my_prompts[x][2],
-                                                                                        1]
+                segments.append((my_prompts[x][1], my_prompts[x][2], my_prompts[x][1], my_prompts[x][2]))
+            timeline.prompt_segment[my_prompts[x][0]] = x
+            timeline.prompt_weight[my_prompts[x][0]] = 1.0
             if x > 0:
-                df.loc[my_prompts[x][0] - 1, 'prompt'] = 0
+                timeline.prompt_weight[my_prompts[x][0] - 1] = 0.0
 
-    df.at[df.index[-1], 'prompt'] = 0
-    df.loc[:, ['pos1', 'neg1', 'pos2', 'neg2']] = df.loc[:, ['pos1', 'neg1', 'pos2', 'neg2']].ffill()
+    timeline.prompt_weight[frame_count] = 0.0
     if mysettings['debug']:
         print("DBG prompts:")
-        print(df[['pos1', 'neg1', 'pos2', 'neg2', 'prompt']])
+        print(timeline.prompt_segment.anchors, timeline.prompt_weight.anchors)
 
     ##
     ## Seeds
@@ -335,83 +402,123 @@ def process_keyframes(mysettings: dict) -> pd.DataFrame:
         if mysettings['seed_travel']:
             if mysettings['debug']: print("DBG seed: More than 1 seed, seed travel enabled.")
             # Try to interpolate from seed -> sub-seed, by increasing sub-seed strength
+            timeline.seed_start = interpolation.KeyframeTrack('step')
+            timeline.seed_end = interpolation.KeyframeTrack('step')
             idxs = list(my_seeds.keys())
             idxs.sort()
             for idx in range(len(idxs)):
                 if idx < len(my_seeds) - 1:
-                    df.loc[idxs[idx], ['seed_start', 'seed_end', 'seed_str']] = [str(my_seeds[idxs[idx]]),
-                                                                                 str(my_seeds[idxs[idx + 1]]),
-                                                                                 0]
+                    timeline.seed_start[idxs[idx]] = my_seeds[idxs[idx]]
+                    timeline.seed_end[idxs[idx]] = my_seeds[idxs[idx + 1]]
+                    timeline.seed_str[idxs[idx]] = 0.0
                 if idx == len(my_seeds) - 2:
-                    df.at[df.index[-1], 'seed_str'] = 1
+                    timeline.seed_str[frame_count] = 1.0
                 if idx > 0:
-                    df.loc[idxs[idx] - 1, 'seed_str'] = 1  # Ensure all values tend to one in the list
-
-            if mysettings['debug']: print(f"DBG seed: Keyframes loaded:\n{df[['seed_start', 'seed_end', 'seed_str']]}")
-            df.loc[:, ['seed_start', 'seed_end']] = df.loc[:, ['seed_start', 'seed_end']].ffill()
-            if mysettings['debug']: print(f"DBG seed: Forward Fill:\n{df[['seed_start', 'seed_end', 'seed_str']]}")
+                    timeline.seed_str[idxs[idx] - 1] = 1.0  # Ensure all values tend to one in the list
         else:
             if mysettings['debug']: print("DBG seed: More than 1 seed, seed travel disabled.")
             # Just interpolate from one seed value to the next. experimental. Set sub-seed to None to disable.
             for idx in my_seeds:
-                df.loc[idx, 'seed_start'] = my_seeds[idx]
-            if mysettings['debug']: print(df['seed_start'])
-            df.loc[:, 'seed_start'] = df.loc[:, 'seed_start'].interpolate(limit_direction='both').map(int)
-            if mysettings['debug']: print(df['seed_start'])
-            df['seed_end'] = None
-            df['seed_str'] = 0
+                timeline.seed_start[idx] = my_seeds[idx]
+            timeline.seed_str[0] = 0.0
     else:
         if mysettings['debug']: print("DBG seed: Only one seed, series fill.")
         # No seed keyframes, series fill the initial seed value. Set sub-seed to None to disable travelling.
-        df.at[0, 'seed_start'] = my_seeds[0]
-        df.at[df.index[-1], 'seed_start'] = my_seeds[0] + frame_count
-        df.loc[:, 'seed_start'] = df.loc[:, 'seed_start'].interpolate(limit_direction='both').map(int)
-        df['seed_end'] = None
-        df['seed_str'] = 0
-
-    # Interpolate columns individually depending on how many data points.
-    for name, values in df.items():
-        if name in ['prompt', 'seed_str']:
-            df.loc[:, name] = df.loc[:, name].interpolate(limit_direction='both')
-        elif values.count() > 3:
-            df.loc[:, name] = df.loc[:, name].interpolate(limit_direction='both', method="polynomial", order=2)
-            df.loc[:, name] = df.loc[:, name].interpolate(limit_direction='both')  # catch last null values.
-        else:
-            df.loc[:, name] = df.loc[:, name].interpolate(limit_direction='both')
+        timeline.seed_start[0] = my_seeds[0]
+        timeline.seed_start[frame_count] = my_seeds[0] + frame_count
+        timeline.seed_str[0] = 0.0
+
+    if mysettings['debug']:
+        print(f"DBG seed: Keyframes loaded:\n{timeline.seed_start.anchors}\n{timeline.seed_str.anchors}")
+
+    csv_filename = os.path.join(mysettings['output_path'], "keyframes.csv")
+    timeline.anchors_frame().to_csv(csv_filename)
+
+    return timeline
 
-    if mysettings['debug']: print(f"DBG seed: Post interpolation:\n{df[['seed_start', 'seed_end', 'seed_str']]}")
 
+def build_prompt(mysettings: dict, segment: Tuple[str, str, str, str], weight: float) -> Tuple[str, str]:
+    """
+    Build the positive and negative prompt for a frame, from the prompt segment it is in and the blend weight
+    towards the first prompt of that segment.
+    """
+    pos1, neg1, pos2, neg2 = segment
     if mysettings['prompt_interpolation']:
+        w1 = str(float(weight))
+        w2 = str(1.0 - float(weight))
         # Check if templates are filled in. If not, try grab prompts at top (i.e. image sent from png info)
         if len(mysettings['tmpl_pos']) == 0:
-            df['pos_prompt'] = df['pos1'].map(str) + ':' + df['prompt'].map(str) + ' AND ' + \
-                               df['pos2'].map(str) + ':' + (1.0 - df['prompt']).map(str)
+            pos_prompt = f"{pos1}:{w1} AND {pos2}:{w2}"
         else:
-            df['pos_prompt'] = mysettings['tmpl_pos'] + ', ' + df['pos1'].map(str) + ':' + df['prompt'].map(str) + \
-                               ' AND ' + mysettings['tmpl_pos'] + ',' + df['pos2'].map(str) + ':' + \
-                               (1.0 - df['prompt']).map(str)
+            pos_prompt = f"{mysettings['tmpl_pos']}, {pos1}:{w1} AND {mysettings['tmpl_pos']},{pos2}:{w2}"
         if len(mysettings['tmpl_neg']) == 0:
-            df['neg_prompt'] = df['neg1'].map(str) + ':' + df['prompt'].map(str) + ' AND ' + \
-                               df['neg2'].map(str) + ':' + (1.0 - df['prompt']).map(str)
+            neg_prompt = f"{neg1}:{w1} AND {neg2}:{w2}"
         else:
-            df['neg_prompt'] = mysettings['tmpl_neg'] + ',' + df['neg1'].map(str) + ':' + df['prompt'].map(str) + \
-                               ' AND ' + mysettings['tmpl_neg'] + ', ' + df['neg2'].map(str) + ':' + \
-                               (1.0 - df['prompt']).map(str)
+            neg_prompt = f"{mysettings['tmpl_neg']},{neg1}:{w1} AND {mysettings['tmpl_neg']}, {neg2}:{w2}"
     else:
-        if len(mysettings['tmpl_pos']) == 0:
-            df['pos_prompt'] = df['pos1'].map(str)
+        pos_prompt = pos1 if len(mysettings['tmpl_pos']) == 0 else f"{mysettings['tmpl_pos']}, {pos1}"
+        neg_prompt = neg1 if len(mysettings['tmpl_neg']) == 0 else f"{mysettings['tmpl_neg']}, {neg1}"
+
+    return pos_prompt, neg_prompt
+
+
+class FrameSchedule:
+    """
+    Flat, structure of arrays view of the keyframe timeline, so the render loops can pull per frame values with
+    plain array indexing instead of pandas label lookups.
+    """
+
+    def __init__(self, mysettings: dict, timeline: KeyframeTimeline):
+        self.frame_count = timeline.frame_count + 1
+        self.prompt_settings = {k: mysettings[k] for k in ['prompt_interpolation', 'tmpl_pos', 'tmpl_neg']}
+        tracks = timeline.tracks
+        stop = self.frame_count
+
+        # Transform, per frame values.
+        self.x_shift = tracks['x_shift'].values(0, stop)
+        self.y_shift = tracks['y_shift'].values(0, stop)
+        self.zoom = tracks['zoom'].values(0, stop)
+        self.rotation = tracks['rotation'].values(0, stop)
+
+        # Perspective deltas as (frame, corner, xy), and a mask of frames that actually need the warp.
+        self.perspective = np.stack([tracks[name].values(0, stop) for name in PERSPECTIVE_PARAMETERS],
+                                    axis=1).reshape(-1, 4, 2)
+        self.unsharpen = tracks['punsharpen'].values(0, stop)
+        self.has_perspective = np.any(self.perspective != 0, axis=(1, 2))
+
+        self.denoise = tracks['denoise'].values(0, stop)
+        self.noise = tracks['noise'].values(0, stop)
+        self.cfg_scale = tracks['cfg_scale'].values(0, stop)
+
+        # Seeds. Sub-seeds are disabled (None) when not seed travelling, flagged by a -1.
+        self.seed = timeline.seed_start.values(0, stop, dtype=np.int64)
+        if timeline.seed_end is None:
+            self.subseed = np.full(stop, -1, dtype=np.int64)
         else:
-            df['pos_prompt'] = mysettings['tmpl_pos'] + ', ' + df['pos1'].map(str)
-        if len(mysettings['tmpl_neg']) == 0:
-            df['neg_prompt'] = df['neg1'].map(str)
-        else:
-            df['neg_prompt'] = mysettings['tmpl_neg'] + ', ' + df['neg1'].map(str)
+            self.subseed = timeline.seed_end.values(0, stop, dtype=np.int64)
+        self.subseed_strength = timeline.seed_str.values(0, stop)
 
-    if mysettings['debug']:
-        print("DBG post interpolation:")
-        print(df[['pos_prompt', 'neg_prompt', 'prompt']])
+        # Prompts only change at keyframes, so store each segment once and index into it, with a blend weight.
+        self.prompt_index = timeline.prompt_segment.values(0, stop, dtype=np.int32)
+        self.prompt_weight = timeline.prompt_weight.values(0, stop)
+        self.prompts = list(timeline.prompt_segments)
+
+        self.events = timeline.events
+        self.events_by_frame = {}
+        for event in self.events:
+            self.events_by_frame.setdefault(event.frame_no, []).append(event)
+
+    def events_at(self, frame_no: int) -> list:
+        return self.events_by_frame.get(frame_no, [])
+
+    def prompt(self, frame_no: int) -> Tuple[str, str]:
+        return build_prompt(self.prompt_settings, self.prompts[self.prompt_index[frame_no]],
+                            self.prompt_weight[frame_no])
+
+    def seeds(self, frame_no: int) -> Tuple[int, Optional[int], float]:
+        subseed = int(self.subseed[frame_no])
+        return int(self.seed[frame_no]), None if subseed == -1 else subseed, float(self.subseed_strength[frame_no])
 
-    csv_filename = os.path.join(mysettings['output_path'], "keyframes.csv")
-    df.to_csv(csv_filename)
 
-    return df
\ No newline at end of file
+def compile_schedule(mysettings: dict, timeline: KeyframeTimeline) -> FrameSchedule:
+    return FrameSchedule(mysettings, timeline)
@@ -1,36 +1,69 @@
 import math
 import os
-import cv2
 
-from scripts.functions import keyframe_functions, preprocessing, postprocessing
+from scripts.functions import frames, frame_writer, keyframe_functions, preprocessing, postprocessing, prepwork, \
+    prop_cache, sources
 from modules import processing, shared, sd_models
 from modules.processing import Processed
 from modules.shared import state
 from PIL import Image, ImageEnhance
-import glob
+
+
+def batch_frames(schedule: keyframe_functions.FrameSchedule, start: int, stop: int, batch_size: int) -> list:
+    """
+    List of consecutive frame numbers from start that can go through img2img in one call. Only possible when the init
+    images come from a source rather than the last frame. A batch is cut short at a model change, or when the
+    denoising strength changes, as webui only takes one value per call. The same goes for the subseed strength, unless
+    per image strengths work in this webui version.
+    """
+    batch = [start]
+    while len(batch) < batch_size and batch[-1] + 1 < stop:
+        next_frame = batch[-1] + 1
+        if any(isinstance(e, keyframe_functions.ModelEvent) for e in schedule.events_at(next_frame)) or \
+                schedule.denoise[next_frame] != schedule.denoise[start] or \
+                not prepwork.same_subseed_strength(schedule, start, next_frame):
+            break
+        batch.append(next_frame)
+    return batch
+
+
+def variation_paths(myset: dict) -> list:
+    """
+    Output folder for each loopback variation. A single run writes straight into the output folder.
+    """
+    if int(myset['variations']) <= 1:
+        return [myset['output_path']]
+    return [os.path.join(myset['output_path'], f"variation_{branch:02}") for branch in range(int(myset['variations']))]
 
 
 def main_process(myset: dict,
                  ptxt: processing.StableDiffusionProcessingTxt2Img,
-                 pimg: processing.StableDiffusionProcessingImg2Img) -> any:
+                 pimg: processing.StableDiffusionProcessingImg2Img,
+                 writer: frame_writer.FrameWriter) -> any:
     apply_colour_corrections = True
-    x_shift_cumulative = 0
-    y_shift_cumulative = 0
 
     frame_count = math.ceil(myset['fps'] * myset['total_time'])
     state.job_count = frame_count
 
-    df = keyframe_functions.process_keyframes(myset)
+    schedule = keyframe_functions.compile_schedule(myset, keyframe_functions.process_keyframes(myset))
+    # Decode props and stamps up front, so missing files are reported before the first frame.
+    prop_cache.preload(schedule.events, shared.opts.animatoranon_prop_folder)
 
     all_images = []
 
-    # Post Processing object dicts
-    text_blocks = {}
+    # Post Processing objects. Props are drawn into the next init image, stamps and text blocks on every frame.
     props = {}
-    stamps = {}
+    overlay = postprocessing.Overlay(shared.opts.animatoranon_prop_folder)
+
+    # Variations are independent loopback chains with different seeds, each with their own folder.
+    variations = max(1, int(myset['variations']))
+    branches = range(variations)
+    output_paths = variation_paths(myset)
 
-    last_frame = None
+    last_frames = [None] * variations
+    last_init_imgs = [pimg.init_images[0]] * variations
     frame_save = 0
+    ext = myset['frame_format']
 
     ptxt.seed = -1
     processing.fix_seed(ptxt)
@@ -39,239 +72,204 @@ def main_process(myset: dict,
     pimg.n_iter = 1
     pimg.do_not_save_grid = True
 
-    initial_color_corrections = None
-
-    # Need to check input source and load video if required.
-    if myset['source'] == 'video':
-        source_cap = cv2.VideoCapture(myset['source_file'])
-    elif myset['source'] == 'images':
-        source_cap = myset['source_file']
-    else:
-        source_cap = None
-
-    # Handle initial frame.
-
-
-    # Main loop through frames
-    for frame_no in range(frame_count):
-
-        if state.interrupted:
-            # Interrupt button pressed in WebUI
-            break
-
-        #############################
-        # Process Keyframes
-        #############################
-        # Check if keyframes exists for this frame
-        # print("process keyframes")
-        if frame_no in myset['keyframes']:
-            # Keyframes exist for this frame.
-            # print(f"\r\nKeyframe at {frame_no}: {myset['keyframes'][frame_no]}\r\n")
-
-            for keyframe in myset['keyframes'][frame_no]:
-                keyframe_command = keyframe[0].lower().strip()
-                # Check the command, should be first item.
-                if keyframe_command == "model" and len(keyframe) == 2:
-                    # Time (s) | model    | model name
-                    info = sd_models.get_closet_checkpoint_match(keyframe[1].strip() + ".ckpt")
-                    if info is None:
-                        raise RuntimeError(f"Unknown checkpoint: {keyframe[1]}")
-                    sd_models.reload_model_weights(shared.sd_model, info)
-
-                elif keyframe_command == "col_set" and len(keyframe) == 1:
-                    # Time (s) | col_set
-                    apply_colour_corrections = True
-                    if frame_no > 0:
-                        # Colour correction is set automatically above
-                        initial_color_corrections = [processing.setup_color_correction(pimg.init_images[0])]
-                elif keyframe_command == "col_clear" and len(keyframe) == 1:
-                    # Time (s) | col_clear
-                    apply_colour_corrections = False
-
-                elif keyframe_command == "prop" and len(keyframe) == 6:
-                    # Time (s) | prop | prop_filename | x pos | y pos | scale | rotation
-                    # bit of a hack, no prop name is supplied, but same function is used to draw.
-                    # so the command is passed in place of prop name, which will be ignored anyway.
-                    props[len(props)] = keyframe
-                elif keyframe_command == "set_stamp" and len(keyframe) == 7:
-                    # Time (s) | set_stamp | stamp_name | stamp_filename | x pos | y pos | scale | rotation
-                    stamps[keyframe[1].strip()] = keyframe[1:]
-                elif keyframe_command == "clear_stamp" and len(keyframe) == 2:
-                    # Time (s) | clear_stamp | stamp_name
-                    if keyframe[1].strip() in stamps:
-                        stamps.pop(keyframe[1].strip())
-
-                elif keyframe_command == "set_text" and len(keyframe) == 10:
-                    # time_s | set_text | name | text_prompt | x | y | w | h | fore_color | back_color | font_name
-                    text_blocks[keyframe[1].strip()] = keyframe[1:]
-                elif keyframe_command == "clear_text" and len(keyframe) == 2:
-                    # Time (s) | clear_text | textblock_name
-                    if keyframe[1].strip() in text_blocks:
-                        text_blocks.pop(keyframe[1].strip())
-
-        #############################
-        # Get source frame
-        #############################
-        # print("Animator: Get/Generate Source Image.")
-        if myset['source'] == 'video':
-            source_cap.set(1, frame_no)
-            ret, tmp_array = source_cap.read()
-            init_img = Image.fromarray(cv2.cvtColor(tmp_array, cv2.COLOR_BGR2RGB).astype('uint8'), 'RGB')
-        elif myset['source'] == 'images':
-            if frame_no >= len(source_cap):
-                init_img = Image.open(source_cap[-1])
-                print('Out of frames, reverting to last frame!')
-            else:
-                init_img = Image.open(source_cap[frame_no])
-        elif frame_no == 0:
-            # Generate initial image
-            print(f"Initial Image: {myset['initial_img']}")
-            if myset['initial_img'] is None:
-                ptxt.prompt = str(df.loc[0, ['pos_prompt']][0])
-                ptxt.negative_prompt = str(df.loc[0, ['neg_prompt']][0])
-                init_processed = processing.process_images(ptxt)
-                init_img = init_processed.images[0]
-            else:
-                init_img = myset['initial_img']
-                pimg.mask = myset['mask']
-
-                if init_img.size != (myset['width'], myset['height']):
-                    init_img = init_img.resize((myset['width'], myset['height']), Image.Resampling.LANCZOS)
-                    if pimg.mask is not None:
-                        pimg.mask = pimg.mask.resize((myset['width'], myset['height']), Image.Resampling.LANCZOS)
-        else:
-            init_img = last_frame
-
-        if init_img.mode != 'RGBA':
-            init_img = init_img.convert('RGBA')
-
-        if frame_no == 0:
-            initial_color_corrections = preprocessing.old_setup_color_correction(init_img)
-            # [processing.setup_color_correction(init_img)]
-
-        ############################
-        # Pre-process source frame
-        ############################
-        # print("Animator: Pre-process Source Frame.")
-        # Update transform details
-        x_shift_per_frame = df.loc[frame_no, ['x_shift']][0]
-        y_shift_per_frame = df.loc[frame_no, ['y_shift']][0]
-        rot_per_frame = df.loc[frame_no, ['rotation']][0]
-        zoom_factor = df.loc[frame_no, ['zoom']][0]
-
-        # Translate source frame when source is img2img where they have an effect frame to frame.
-        x_shift_cumulative = x_shift_cumulative + x_shift_per_frame
-        y_shift_cumulative = y_shift_cumulative + y_shift_per_frame
-
-        if x_shift_per_frame != 0 or y_shift_per_frame != 0 or rot_per_frame != 0 or zoom_factor != 1.0:
-            init_img = preprocessing.transform_image(init_img, rot_per_frame, int(x_shift_cumulative),
-                                                     int(y_shift_cumulative), zoom_factor)
-
-        # Subtract the integer portion we just shifted.
-        x_shift_cumulative = x_shift_cumulative - int(x_shift_cumulative)
-        y_shift_cumulative = y_shift_cumulative - int(y_shift_cumulative)
-
-        # Perspective transform
-        if  df.loc[frame_no, ['px0']][0] != 0 or df.loc[frame_no, ['py0']][0] != 0 or \
-            df.loc[frame_no, ['px1']][0] != 0 or df.loc[frame_no, ['py1']][0] != 0 or \
-            df.loc[frame_no, ['px2']][0] != 0 or df.loc[frame_no, ['py2']][0] != 0 or \
-            df.loc[frame_no, ['px3']][0] != 0 or df.loc[frame_no, ['py3']][0] != 0:
-
-            init_img = \
-                preprocessing.perspective_transform(init_img,
-                                                    [(df.loc[frame_no, ['px0']][0], df.loc[frame_no, ['py0']][0]),
-                                                     (df.loc[frame_no, ['px1']][0], df.loc[frame_no, ['py1']][0]),
-                                                     (df.loc[frame_no, ['px2']][0], df.loc[frame_no, ['py2']][0]),
-                                                     (df.loc[frame_no, ['px3']][0], df.loc[frame_no, ['py3']][0])],
-                                                    [(0, 0), (0, 0), (0, 0), (0, 0)],
-                                                    df.loc[frame_no, ['punsharpen']][0])
-
-        # Props
-        if len(props) > 0:
-            # print("Pasting prop into image.")
-            init_img = postprocessing.paste_prop(init_img, props, shared.opts.animatoranon_prop_folder)
-            props = {}
-
-        # Noise
-        if myset['add_noise']:
-            # print("Adding Noise!!")
-            init_img = preprocessing.add_simple_noise(init_img, df.loc[frame_no, ['noise']][0])
-
-        #############################
-        # Process source frame into destination frame
-        #############################
-        # print("Animator: Process Source Frame.")
-        if apply_colour_corrections:
-            init_img = preprocessing.old_apply_color_correction(initial_color_corrections, init_img, myset['mask'])
-
-        # Set prompts
-        pimg.prompt = str(df.loc[frame_no, ['pos_prompt']][0])
-        pimg.negative_prompt = str(df.loc[frame_no, ['neg_prompt']][0])
-
-        pimg.seed = int(df.loc[frame_no, ['seed_start']][0])
-        pimg.subseed = None \
-            if df.loc[frame_no, ['seed_end']][0] is None else int(df.loc[frame_no, ['seed_end']][0])
-        pimg.subseed_strength = None \
-            if df.loc[frame_no, ['seed_str']][0] is None else float(df.loc[frame_no, ['seed_str']][0])
-        # print(f"Frame:{frame_no} Seed:{pimg.seed} Sub:{pimg.subseed} Str:{pimg.subseed_strength}")
-
-        pimg.denoising_strength = df.loc[frame_no, ['denoise']][0]
-
-        pimg.init_images = [init_img]
-
-        if myset['debug']:
-            pimg.init_images[0].save(os.path.join(myset['output_path'], f"frame_{frame_save:05}_a.png"))
-
-        processed = processing.process_images(pimg)
-
-        if myset['debug']:
-            processed.images[0].save(os.path.join(myset['output_path'], f"frame_{frame_save:05}_b.png"))
-
-        #############################
-        # Post-process destination frame
-        #############################
-        # print("Animator: Post-Process Source Frame.")
-        post_processed_image = processed.images[0].copy()
-        if post_processed_image.mode != 'RGBA':
-            post_processed_image = post_processed_image.convert('RGBA')
-
-        if len(stamps) > 0:
-            post_processed_image = postprocessing.paste_prop(post_processed_image,
-                                                             stamps,
-                                                             shared.opts.animatoranon_prop_folder)
-        if len(text_blocks) > 0:
-            post_processed_image = postprocessing.render_text_block(post_processed_image, text_blocks)
-
-        #############################
-        # Save frame
-        #############################
-        # Create and save smoothed intermediate frames
-        if frame_no > 0 and myset['smoothing'] > 0 and not myset['film_interpolation']:
-            # working a frame behind, smooth from last_frame -> post_processed_image
-            for idx, img in enumerate(postprocessing.morph(last_frame, post_processed_image, myset['smoothing'])):
-                if myset['debug']:
-                    img.save(os.path.join(myset['output_path'], f"frame_{frame_save:05}_p.png"))
+    initial_color_corrections = [None] * variations
+
+    # Source frames are read ahead in the background, at the animation frame rate and size.
+    with sources.open_source(myset, shared.opts.animatoranon_source_cache.strip(),
+                             shared.opts.animatoranon_source_cache_mb) as source_cap:
+        # With a source, init images don't depend on the last frame, so several frames can be diffused at once.
+        # Variations already fill the batch, one frame at a time.
+        batch_size = max(1, int(myset['batch_size'])) if source_cap is not None and variations == 1 else 1
+
+        # Handle initial frame.
+
+
+        # Main loop through batches of frames
+        frame_no = 0
+        while frame_no < frame_count:
+
+            if state.interrupted:
+                # Interrupt button pressed in WebUI
+                break
+
+            batch = batch_frames(schedule, frame_no, frame_count, batch_size)
+            # One init image per frame and variation, in that order.
+            init_images = []
+
+            for frame_no in batch:
+                #############################
+                # Process Keyframes
+                #############################
+                # Post processing keyframes are handled after diffusion, one frame at a time.
+                for event in schedule.events_at(frame_no):
+                    if isinstance(event, keyframe_functions.ModelEvent):
+                        # Time (s) | model    | model name
+                        sd_models.reload_model_weights(shared.sd_model, event.checkpoint)
+
+                    elif isinstance(event, keyframe_functions.ColourCorrectionEvent):
+                        # Time (s) | col_set, Time (s) | col_clear
+                        apply_colour_corrections = event.enabled
+                        if event.enabled and frame_no > 0:
+                            # Colour correction is set automatically above
+                            initial_color_corrections = [preprocessing.ColorCorrection(img) for img in last_init_imgs]
+
+                    elif type(event) is keyframe_functions.PropEvent:
+                        # Time (s) | prop | prop_filename | x pos | y pos | scale | rotation
+                        props[len(props)] = event
+
+                #############################
+                # Get source frame
+                #############################
+                # print("Animator: Get/Generate Source Image.")
+                source_imgs = None
+                if source_cap is not None:
+                    source_img = source_cap.frame(frame_no)
+                elif frame_no == 0:
+                    # Generate initial image
+                    print(f"Initial Image: {myset['initial_img']}")
+                    if myset['initial_img'] is None:
+                        # One per variation, webui steps the seed for each image in the batch.
+                        ptxt.prompt, ptxt.negative_prompt = schedule.prompt(0)
+                        ptxt.batch_size = variations
+                        init_processed = processing.process_images(ptxt)
+                        source_imgs = init_processed.images[init_processed.index_of_first_image:
+                                                            init_processed.index_of_first_image + variations]
+                    else:
+                        source_img = myset['initial_img']
+                        pimg.mask = myset['mask']
+
+                        if source_img.size != (myset['width'], myset['height']):
+                            source_img = source_img.resize((myset['width'], myset['height']), Image.Resampling.LANCZOS)
+                            if pimg.mask is not None:
+                                pimg.mask = pimg.mask.resize((myset['width'], myset['height']),
+                                                             Image.Resampling.LANCZOS)
                 else:
-                    img.save(os.path.join(myset['output_path'], f"frame_{frame_save:05}.png"))
-                print(f"{frame_save:03}: {frame_no:03} > {idx} smooth frame")
-                frame_save += 1
-
-        # print("Animator: Save Frame")
-        if frame_no % int(myset['fps']) == 0:
-            all_images.append(post_processed_image)
-
-        # don't post process the loopback frame.
-        last_frame = processed.images[0]
-        if last_frame.mode != 'RGBA':
-            last_frame = last_frame.convert('RGBA')
-
-        if myset['debug']:
-            post_processed_image.save(os.path.join(myset['output_path'], f"frame_{frame_save:05}_c.png"))
-        else:
-            post_processed_image.save(os.path.join(myset['output_path'], f"frame_{frame_save:05}.png"))
-        frame_save += 1
-
-        shared.state.current_image = post_processed_image
+                    source_imgs = last_frames
+
+                if source_imgs is None:
+                    source_imgs = [source_img] * variations
+
+                ############################
+                # Pre-process source frame
+                ############################
+                # print("Animator: Pre-process Source Frame.")
+                # Update transform details
+                x_shift_per_frame = schedule.x_shift[frame_no]
+                y_shift_per_frame = schedule.y_shift[frame_no]
+                rot_per_frame = schedule.rotation[frame_no]
+                zoom_factor = schedule.zoom[frame_no]
+
+                perspective = schedule.perspective[frame_no] if schedule.has_perspective[frame_no] else None
+                unsharpen = schedule.unsharpen[frame_no] if schedule.has_perspective[frame_no] else 0
+
+                for branch in branches:
+                    # Pre-processed as one array, only made into an image again for img2img.
+                    init = frames.to_array(source_imgs[branch])
+
+                    if frame_no == 0:
+                        initial_color_corrections[branch] = preprocessing.ColorCorrection(init)
+
+                    # Zoom, rotation, shift and perspective in one warp. Shifts can be fractions of a pixel.
+                    if x_shift_per_frame != 0 or y_shift_per_frame != 0 or rot_per_frame != 0 or zoom_factor != 1.0 or \
+                            perspective is not None:
+                        warp = preprocessing.warp_matrix((init.shape[1], init.shape[0]), rot_per_frame,
+                                                         x_shift_per_frame, y_shift_per_frame, zoom_factor, perspective)
+                        init = preprocessing.warp_array(init, warp, unsharpen)
+
+                    # Props
+                    if len(props) > 0:
+                        # print("Pasting prop into image.")
+                        init = postprocessing.paste_prop_array(init, props, shared.opts.animatoranon_prop_folder)
+
+                    # Noise
+                    if myset['add_noise']:
+                        # print("Adding Noise!!")
+                        # Seeded by frame and variation, so a frame gets the same noise however it is rendered.
+                        init = preprocessing.draw_noise(frames.writable(init), schedule.noise[frame_no],
+                                                        preprocessing.noise_rng(schedule.seeds(frame_no)[0], frame_no,
+                                                                                branch))
+
+                    if apply_colour_corrections:
+                        init = initial_color_corrections[branch].apply_array(init, myset['mask'])
+
+                    init_img = frames.to_image(init)
+                    init_images.append(init_img)
+                    last_init_imgs[branch] = init_img
+
+                # Props are only drawn once.
+                props = {}
+
+            #############################
+            # Process source frames into destination frames
+            #############################
+            # print("Animator: Process Source Frames.")
+            # Set prompts and seeds, each frame and variation in the batch keeps its own.
+            strengths = prepwork.set_frame_parameters(pimg, schedule, batch, variations)
+
+            pimg.init_images = init_images
+
+            with prepwork.per_image_subseed_strength(pimg, strengths):
+                processed = processing.process_images(pimg)
+
+            for idx, frame_no in enumerate(batch):
+
+                #############################
+                # Post-process destination frame
+                #############################
+                # print("Animator: Post-Process Source Frame.")
+                for event in schedule.events_at(frame_no):
+                    # Stamps and text blocks
+                    overlay.apply_event(event)
+
+                # Every variation of this frame is saved under the same frame number, in its own folder.
+                branch_frame_save = frame_save
+                for branch in branches:
+                    frame_save = branch_frame_save
+                    output_path = output_paths[branch]
+                    processed_image = processed.images[processed.index_of_first_image + idx * variations + branch]
+
+                    if myset['debug']:
+                        writer.save(init_images[idx * variations + branch],
+                                    os.path.join(output_path, f"frame_{frame_save:05}_a.{ext}"))
+                        writer.save(processed_image, os.path.join(output_path, f"frame_{frame_save:05}_b.{ext}"))
+
+                    post_processed_image = overlay.apply(processed_image)
+
+                    #############################
+                    # Save frame
+                    #############################
+                    # Create and save smoothed intermediate frames
+                    if frame_no > 0 and myset['smoothing'] > 0 and not myset['film_interpolation']:
+                        # working a frame behind, smooth from last_frame -> post_processed_image
+                        smooth_frames = postprocessing.interpolate(last_frames[branch], post_processed_image,
+                                                                   myset['smoothing'], myset['flow_smoothing'])
+                        for smooth_idx, img in enumerate(smooth_frames):
+                            if myset['debug']:
+                                writer.frame(img, os.path.join(output_path, f"frame_{frame_save:05}_p.{ext}"))
+                            else:
+                                writer.frame(img, os.path.join(output_path, f"frame_{frame_save:05}.{ext}"))
+                            print(f"{frame_save:03}: {frame_no:03} > {smooth_idx} smooth frame")
+                            frame_save += 1
+
+                    # print("Animator: Save Frame")
+                    if frame_no % int(myset['fps']) == 0:
+                        all_images.append(post_processed_image)
+
+                    # don't post process the loopback frame.
+                    last_frame = processed_image
+                    if last_frame.mode != 'RGBA':
+                        last_frame = last_frame.convert('RGBA')
+                    last_frames[branch] = last_frame
+
+                    if myset['debug']:
+                        writer.frame(post_processed_image, os.path.join(output_path, f"frame_{frame_save:05}_c.{ext}"))
+                    else:
+                        writer.frame(post_processed_image, os.path.join(output_path, f"frame_{frame_save:05}.{ext}"))
+                    frame_save += 1
+
+                    shared.state.current_image = post_processed_image
+
+            frame_no = batch[-1] + 1
 
     Processed(pimg, all_images, 0, "")
     print("Done.")
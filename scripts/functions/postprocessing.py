@@ -1,8 +1,12 @@
+import functools
 import os
 
+import cv2
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
+from scripts.functions import events, frames, prop_cache
+
 
 def paste_prop(img: Image, props: dict, prop_folder: str) -> Image:
     if img.mode != 'RGB':
@@ -10,21 +14,18 @@ def paste_prop(img: Image, props: dict, prop_folder: str) -> Image:
     else:
         img2 = img
 
-    for prop_name in props:
-        # prop_name | prop filename | x pos | y pos | scale | rotation
-        prop_filename = os.path.join(prop_folder.strip(), str(props[prop_name][1]).strip())
-        x = int(props[prop_name][2])
-        y = int(props[prop_name][3])
-        scale = float(props[prop_name][4])
-        rotation = float(props[prop_name][5])
+    for prop_event in props.values():
+        # PropEvent or StampEvent, already parsed.
+        prop_filename = os.path.join(prop_folder.strip(), prop_event.filename)
+        x = prop_event.x
+        y = prop_event.y
 
-        if not os.path.exists(prop_filename):
+        try:
+            # Already scaled and rotated, from the cache.
+            prop2 = prop_cache.sprites.sprite(prop_filename, prop_event.scale, prop_event.rotation)
+        except OSError:
             print("Prop: Cannot locate file: " + prop_filename)
-            return img
-
-        prop = Image.open(prop_filename)
-        w2, h2 = prop.size
-        prop2 = prop.resize((int(w2 * scale), int(h2 * scale)), Image.Resampling.LANCZOS).rotate(rotation, expand=True)
+            continue
         w3, h3 = prop2.size
 
         tmplayer = Image.new('RGBA', img.size, (0, 0, 0, 0))
@@ -34,90 +35,223 @@ def paste_prop(img: Image, props: dict, prop_folder: str) -> Image:
     return img2# .convert("RGB")
 
 
+def paste_prop_array(arr: np.ndarray, props: dict, prop_folder: str) -> np.ndarray:
+    """
+    paste_prop() on an RGBA frame array, in place if it can be changed. Only the box each prop covers is made into an
+    image and blended, the rest of the frame is left as it is.
+    """
+    arr = frames.writable(arr)
+    height, width = arr.shape[:2]
+    for prop_event in props.values():
+        prop_filename = os.path.join(prop_folder.strip(), prop_event.filename)
+        try:
+            prop2 = prop_cache.sprites.sprite(prop_filename, prop_event.scale, prop_event.rotation)
+        except OSError:
+            print("Prop: Cannot locate file: " + prop_filename)
+            continue
+        w3, h3 = prop2.size
+        x0 = int(prop_event.x - w3 / 2)
+        y0 = int(prop_event.y - h3 / 2)
+
+        # Clipped to the frame.
+        left, top = max(0, x0), max(0, y0)
+        right, bottom = min(width, x0 + w3), min(height, y0 + h3)
+        if left >= right or top >= bottom:
+            continue
+        region = Image.fromarray(arr[top:bottom, left:right], 'RGBA')
+        region.alpha_composite(prop2.crop((left - x0, top - y0, right - x0, bottom - y0)))
+        arr[top:bottom, left:right] = np.asarray(region)
+    return arr
+
+
+# Text blocks are fitted to the largest font size up to this that fits their box. If the text fits at every size, it
+# is drawn at the default size.
+MAX_FONT_SIZE = 69
+DEFAULT_FONT_SIZE = 20
+# Rounding and edge padding of the bubble background.
+TEXT_BLOCK_PAD = 1
+
+# Only used to measure text.
+_measure = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+
+
+@functools.lru_cache(maxsize=256)
+def load_font(font_name: str, size: int) -> ImageFont.FreeTypeFont:
+    # Each font face is only read from disk and loaded once per size.
+    return ImageFont.truetype(font_name, size)
+
+
+def text_bbox(text: str, font_name: str, size: int) -> tuple:
+    return _measure.multiline_textbbox((0, 0), text, font=load_font(font_name, size), align='center')
+
+
+@functools.lru_cache(maxsize=1024)
+def fit_text(text: str, w: int, h: int, font_name: str) -> tuple:
+    """
+    Font size and bounding box of text fitted into a w x h block, remembered so an unchanged block is only measured
+    once. The size is found by binary search, text only gets bigger with the font size. Text too big at size 1 is
+    drawn at size 1.
+    """
+    def fits(size):
+        bbox = text_bbox(text, font_name, size)
+        return bbox[2] - bbox[0] <= w - TEXT_BLOCK_PAD * 2 and bbox[3] - bbox[1] <= h - TEXT_BLOCK_PAD * 2
+
+    if fits(MAX_FONT_SIZE):
+        size = DEFAULT_FONT_SIZE
+    else:
+        # Largest size that fits, low always fits (or is 1) and high never does.
+        low, high = 1, MAX_FONT_SIZE
+        while high - low > 1:
+            middle = (low + high) // 2
+            if fits(middle):
+                low = middle
+            else:
+                high = middle
+        size = low
+    return size, text_bbox(text, font_name, size)
+
+
 def render_text_block(img: Image, text_blocks: dict) -> Image:
-    pad = 1  # Rounding and edge padding of the bubble background.
+    pad = TEXT_BLOCK_PAD
     d1 = ImageDraw.Draw(img)
-    font_size = 20
-    for text_name in text_blocks:
-        # textblock_name | text_prompt | x | y | w | h | back_color | white_color | font_filename
-        text_prompt = str(text_blocks[text_name][1]).strip().replace('\\n', '\n')
-        x = int(text_blocks[text_name][2])
-        y = int(text_blocks[text_name][3])
-        w = int(text_blocks[text_name][4])
-        h = int(text_blocks[text_name][5])
-        # Try to convert text to a tuple (255,255,255) or just leave as text "white"
-        try:
-            background_colour = eval(text_blocks[text_name][6].strip())
-        except:
-            background_colour = text_blocks[text_name][6].strip()
-        try:
-            foreground_colour = eval(text_blocks[text_name][7].strip())
-        except:
-            foreground_colour = text_blocks[text_name][7].strip()
-        font_name = str(text_blocks[text_name][8]).strip().lower()
+    for text_event in text_blocks.values():
+        # TextEvent, already parsed. Colours are either a tuple (255,255,255) or text "white".
+        text_prompt = text_event.text
+        x = text_event.x
+        y = text_event.y
+        w = text_event.w
+        h = text_event.h
+        background_colour = text_event.back_colour
+        foreground_colour = text_event.fore_colour
+        font_name = text_event.font_name
         # Auto size the text.
-        for fs in range(70):
-            text_block_font = ImageFont.truetype(font_name, fs)
-            txt_block_size = d1.multiline_textbbox((0, 0), text_prompt, font=text_block_font, align='center')
-            if txt_block_size[2] - txt_block_size[0] > (w - pad * 2) or \
-                    txt_block_size[3] - txt_block_size[1] > (h - pad * 2):
-                font_size = fs - 1
-                break
-
-        text_block_font = ImageFont.truetype(font_name, font_size)
+        font_size, txt_block_size = fit_text(text_prompt, w, h, font_name)
         # print(f"size:{font_size} loc:{x}, {y} size:{w}, {h}")
 
-        txt_block_size = d1.multiline_textbbox((0, 0), text_prompt, font=text_block_font, align='center')
-        # print(f"txt_block_size:{txt_block_size}")
-
         d1.rounded_rectangle((x, y, x + w, y + h), radius=pad, fill=background_colour)
         d1.multiline_text((x + pad, y + pad + (h - txt_block_size[3]) / 2),
                           text_prompt,
                           fill=foreground_colour,
-                          font=text_block_font,
+                          font=load_font(font_name, font_size),
                           align='center')
 
     return img
 
 
-def morph2(img1: Image, img2: Image, count: int) -> list:
+class Overlay:
+    """
+    Stamps and text blocks shown on the animation frames. Stamps stay the same for long stretches, so they are drawn
+    once onto a transparent layer, which is only redrawn after a stamp is set or cleared. Each frame then only has the
+    box the layer covers blended in. Text blocks are drawn straight onto each frame, as they always were, so a
+    translucent back colour still replaces the pixels under it rather than blending with them; the font size is cached,
+    which leaves only the drawing to do.
+    """
+
+    def __init__(self, prop_folder: str, stamps: dict = None, text_blocks: dict = None):
+        self.prop_folder = prop_folder
+        self.stamps = dict(stamps or {})
+        self.text_blocks = dict(text_blocks or {})
+        self._layer = None
+        self._box = None
+
+    def apply_event(self, event: events.KeyframeEvent):
+        if isinstance(event, events.StampEvent):
+            # Time (s) | set_stamp | stamp_name | stamp_filename | x pos | y pos | scale | rotation
+            self.stamps[event.name] = event
+            self._layer = None
+        elif isinstance(event, events.ClearStampEvent):
+            # Time (s) | clear_stamp | stamp_name
+            self.stamps.pop(event.name, None)
+            self._layer = None
+        elif isinstance(event, events.TextEvent):
+            # time_s | set_text | name | text_prompt | x | y | w | h | back_color | fore_color | font_name
+            self.text_blocks[event.name] = event
+        elif isinstance(event, events.ClearTextEvent):
+            # Time (s) | clear_text | textblock_name
+            self.text_blocks.pop(event.name, None)
+
+    def layer(self, size: tuple) -> tuple:
+        # The stamps at a frame size and the box they cover, None if there is nothing to draw.
+        if self._layer is None or self._layer.size != size:
+            layer = Image.new('RGBA', size, (0, 0, 0, 0))
+            if len(self.stamps) > 0:
+                layer = paste_prop(layer, self.stamps, self.prop_folder)
+            self._layer = layer
+            self._box = layer.getchannel('A').getbbox()
+        return self._layer, self._box
+
+    def apply(self, image: Image) -> Image:
+        if len(self.stamps) == 0 and len(self.text_blocks) == 0:
+            return image if image.mode == 'RGBA' else image.convert('RGBA')
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        else:
+            image = image.copy()
+        if len(self.stamps) > 0:
+            layer, box = self.layer(image.size)
+            if box is not None:
+                image.alpha_composite(layer, box[:2], box)
+        if len(self.text_blocks) > 0:
+            image = render_text_block(image, self.text_blocks)
+        return image
+
+
+def morph(img1: Image, img2: Image, count: int):
     """
-    count=4
+    Generator of the count frames blending img1 into img2, e.g. count=4
     img1:0
             0.2 (1/5)
             0.4 (2/5)
             0.6 (3/5)
             0.8 (4/5)
     img2:1
+    Blended in RGBA with 8 bit fixed point weights, one frame at a time.
     """
-    # print(f"img1: {img1.mode} img2: {img2.mode}")
-    arr1 = np.array(img1).astype('float')
-    diff = (np.array(img2).astype('float') - arr1) / (count+1)
-    img_list = []
-    for x in range(0, count):
-        print(f"x: {x}")
-        arr1 += diff
-        img_list.append(Image.fromarray(arr1.astype('uint8'), 'RGBA'))
+    arr1 = frames.to_array(img1).astype(np.uint16)
+    arr2 = frames.to_array(img2).astype(np.uint16)
 
-    return img_list
+    # Weight of img2 out of 256 for each frame, rounded.
+    weights = (np.arange(1, count + 1, dtype=np.uint32) * 256 + (count + 1) // 2) // (count + 1)
 
+    blend = np.empty_like(arr1)
+    scaled = np.empty_like(arr2)
+    for weight in weights.astype(np.uint16):
+        # (img1 * (256 - w) + img2 * w + 128) / 256, all fits in uint16.
+        np.multiply(arr1, 256 - weight, out=blend)
+        np.multiply(arr2, weight, out=scaled)
+        blend += scaled
+        blend += 128
+        blend >>= 8
+        yield frames.to_image(blend.astype(np.uint8))
 
-def morph(img1: Image, img2: Image, count: int) -> list:
-    # Convert images to YCbCr color space and convert to NumPy arrays
-    arr1 = np.array(img1.convert('YCbCr')).astype('float')
-    arr2 = np.array(img2.convert('YCbCr')).astype('float')
 
-    # Compute the difference between the images
-    diff = (arr2 - arr1) / (count + 1)
+def flow_morph(img1: Image, img2: Image, count: int):
+    """
+    Generator of the count frames between img1 and img2, like morph(), but motion compensated. Optical flow is
+    found both ways between the frames, and each in between frame is a blend of img1 warped forward and img2 warped
+    back to that point in time, so things move rather than fade.
+    """
+    arr1 = frames.to_array(img1)
+    arr2 = frames.to_array(img2)
 
-    img_list = []
-    for x in range(0, count):
-        # Update the YCbCr arrays
-        arr1 += diff
+    dis = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_MEDIUM)
+    gray1 = cv2.cvtColor(arr1, cv2.COLOR_RGBA2GRAY)
+    gray2 = cv2.cvtColor(arr2, cv2.COLOR_RGBA2GRAY)
+    flow_forward = dis.calc(gray1, gray2, None)
+    flow_back = dis.calc(gray2, gray1, None)
 
-        # Convert the YCbCr arrays back to the RGB color space
-        img = Image.fromarray(arr1.astype('uint8'), 'YCbCr').convert('RGBA')
+    grid_y, grid_x = np.indices(gray1.shape, dtype=np.float32)
+    for t in np.arange(1, count + 1, dtype=np.float32) / (count + 1):
+        # Where each pixel of the frame at time t was in img1, and will be in img2.
+        warped1 = cv2.remap(arr1, grid_x - t * flow_forward[..., 0], grid_y - t * flow_forward[..., 1],
+                            cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        warped2 = cv2.remap(arr2, grid_x - (1 - t) * flow_back[..., 0], grid_y - (1 - t) * flow_back[..., 1],
+                            cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        yield frames.to_image(cv2.addWeighted(warped1, float(1 - t), warped2, float(t), 0))
 
-        img_list.append(img)
 
-    return img_list
+def interpolate(img1: Image, img2: Image, count: int, optical_flow: bool = False):
+    # Smoothing frames between two rendered frames, with the chosen method.
+    if optical_flow:
+        return flow_morph(img1, img2, count)
+    return morph(img1, img2, count)
@@ -1,119 +1,160 @@
-import random
-from PIL import Image, ImageFilter, ImageDraw, ImageOps
+from PIL import Image, ImageFilter, ImageOps
 import numpy as np
-from skimage import exposure
 import cv2
 
+from scripts.functions import frames
 
-def add_simple_noise(img: Image, percent: float) -> Image:
-    # Draw coloured circles randomly over the image. Lame, but for testing.
-    # print("Noise function")
-    w2, h2 = img.size
-    draw = ImageDraw.Draw(img)
-    for i in range(int(50 * float(percent))):
-        x2 = random.randint(0, w2)
-        y2 = random.randint(0, h2)
-        s2 = random.randint(0, int(50 * float(percent)))
-        pos = (x2, y2, x2 + s2, y2 + s2)
-        draw.ellipse(pos, fill=(random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)),
-                     outline=(0, 0, 0))
-    return img
 
+def noise_rng(seed: int, frame_no: int, variation: int = 0) -> np.random.Generator:
+    # Random numbers for the noise of one frame, the same whatever order the frames are rendered in.
+    return np.random.default_rng([int(seed) & 0xFFFFFFFFFFFFFFFF, int(frame_no), int(variation)])
 
-def transform_image(img: Image, rot: float, x: int, y: int, zoom: float) -> Image:
-    w, h = img.size
 
-    # Zoom image
-    img2 = img.resize((int(w * zoom), int(h * zoom)), Image.Resampling.LANCZOS)
-
-    # Create background image
-    padding = 2
-    resimg = add_simple_noise(img.copy(), 0.75).resize((w + padding * 2, h + padding * 2), Image.Resampling.LANCZOS). \
-        filter(ImageFilter.GaussianBlur(5)). \
-        crop((padding, padding, w + padding, h + padding))
-
-    resimg.paste(img2.rotate(rot), (int((w - img2.size[0]) / 2 + x), int((h - img2.size[1]) / 2 + y)))
-
-    return resimg
-
-
-def perspective_transform(image: Image, src_points, dst_points, unsharpen):
+def add_simple_noise(img: Image, percent: float, rng: np.random.Generator = None) -> Image:
     """
-    Apply perspective transform on pillow image using transformation matrix.
-    Args:
-        image (PIL Image): Input image.
-        src_points (list): List of four delta points from source frame.
-        dst_points (list): List of four delta points from destination frame.
-    Returns:
-        PIL Image: Perspective transformed image.
+    Coloured circles with a black outline at random over the image. Lame, but for testing.
+    The result is a new image, see draw_noise(). Pass a generator from noise_rng() for noise that can be rendered
+    again.
     """
-    # Convert the input image to OpenCV format.
-    image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-    ims = image.shape  # Not an image anymore, but an array
-
-    b = np.float32([[0, 0],
-                    [ims[0], 0],
-                    [ims[0], ims[1]],
-                    [0, ims[1]]
-                   ])
-
-    # Calculate the perspective transformation matrix.
-    src_pts = np.float32(src_points) + b
-    dst_pts = np.float32(dst_points) + b
-    matrix = cv2.getPerspectiveTransform(src_pts, dst_pts)
-
-    # Apply the perspective transformation.
-    transformed = cv2.warpPerspective(image, matrix, (image.shape[1], image.shape[0]))
-
-    # Convert the transformed image back to PIL format.
-    timg = Image.fromarray(cv2.cvtColor(transformed, cv2.COLOR_BGR2RGB))
-
-    return timg.filter(ImageFilter.UnsharpMask(radius=2, percent=int(unsharpen)))
-
-
-def old_setup_color_correction(image):
-    # logging.info("Calibrating color correction.")
-    correction_target = cv2.cvtColor(np.asarray(image.copy()), cv2.COLOR_RGB2LAB)
-    return correction_target
-
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGB')
+    return Image.fromarray(draw_noise(np.array(img), percent, rng), img.mode)
+
+
+def draw_noise(arr: np.ndarray, percent: float, rng: np.random.Generator = None) -> np.ndarray:
+    # add_simple_noise() in place on an RGB or RGBA array. All circles are drawn in one go, later circles on top.
+    if rng is None:
+        rng = np.random.default_rng()
+    # Both the number of circles and their largest size go up with the strength.
+    count = int(50 * float(percent))
+    if count == 0:
+        return arr
+    h, w = arr.shape[:2]
+    x = rng.integers(0, w, count, endpoint=True)
+    y = rng.integers(0, h, count, endpoint=True)
+    size = rng.integers(0, count, count, endpoint=True)
+    colours = rng.integers(0, 256, (count, 3), dtype=np.uint8)
+
+    # Every pixel in the box of every circle, kept if it is inside the circle and the image.
+    offsets = np.arange(size.max() + 1)
+    centres = offsets + 0.5
+    radius = (size + 1) / 2
+    distance = (centres[None, None, :] - radius[:, None, None]) ** 2 + \
+        (centres[None, :, None] - radius[:, None, None]) ** 2
+    circle, row, column = np.nonzero((distance <= radius[:, None, None] ** 2) &
+                                     (x[:, None, None] + offsets[None, None, :] < w) &
+                                     (y[:, None, None] + offsets[None, :, None] < h))
+
+    # Circle colour, or black for the outermost ring of pixels.
+    outline = np.sqrt(distance[circle, row, column]) > radius[circle] - 1
+    fill = np.where(outline[:, None], np.uint8(0), colours[circle])
+    pixels = (y[circle] + row) * w + x[circle] + column
+    # Where circles overlap, the last one drawn wins.
+    pixels, last = np.unique(pixels[::-1], return_index=True)
+    fill = fill[::-1][last]
+
+    flat = arr.reshape(-1, arr.shape[2])
+    flat[pixels, :3] = fill
+    if arr.shape[2] == 4:
+        flat[pixels, 3] = 255
+    return arr
+
+
+def warp_matrix(size: tuple, rot: float, x: float, y: float, zoom: float, perspective=None) -> np.ndarray:
+    """
+    3x3 homography for the whole frame transform: zoom and rotation (counter clockwise, degrees) about the centre,
+    then a shift in pixels, which can be fractional, then the perspective deltas if any. The perspective deltas are
+    moves of the top left, top right, bottom right and bottom left corners, as set by perspective keyframes.
+    """
+    w, h = size
+    matrix = np.eye(3)
+    matrix[:2] = cv2.getRotationMatrix2D((w / 2, h / 2), rot, zoom)
+    matrix[0, 2] += x
+    matrix[1, 2] += y
 
-def old_apply_color_correction(correction, original_image: Image, mask: Image):
-    # logging.info("Applying color correction.")
+    if perspective is not None:
+        corners = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+        matrix = cv2.getPerspectiveTransform(np.float32(perspective) + corners, corners) @ matrix
 
-    if mask:
-        # Invert mask, use it to paste over the top after the coorection..
-        backup_image = original_image.copy()
+    return matrix
 
-        image = Image.fromarray(cv2.cvtColor(exposure.match_histograms(
-            cv2.cvtColor(
-                np.asarray(original_image),
-                cv2.COLOR_RGB2LAB
-            ),
-            correction,
-            channel_axis=2
-        ), cv2.COLOR_LAB2RGB).astype("uint8")).convert('RGBA')
 
-        # Convert grayscale image back to RGB
-        #new_mask = mask.convert('RGB')
+def warp_image(image: Image, matrix: np.ndarray, unsharpen: float = 0) -> Image:
+    # Apply a warp_matrix() in one resample, see warp_array().
+    return Image.fromarray(warp_array(np.asarray(image), matrix, unsharpen), image.mode)
 
-        #print(f"\nold_apply_color_correction backup_image:{backup_image.mode}, {backup_image.size}")
-        #print(f"\nold_apply_color_correction image:{image.mode}, {image.size}")
-        #print(f"\nold_apply_color_correction mask:{mask.mode}, {mask.size}")
 
-        # Combine the modified image with the backup using the alpha mask
-        image = Image.composite(image, backup_image, mask.resize(image.size, Image.Resampling.LANCZOS))
+def warp_array(arr: np.ndarray, matrix: np.ndarray, unsharpen: float = 0) -> np.ndarray:
+    # Apply a warp_matrix() in one resample. The edges are filled by reflecting the frame rather than drawing a
+    # background, loopback soon paints over them anyway.
+    arr = cv2.warpPerspective(arr, matrix, (arr.shape[1], arr.shape[0]), flags=cv2.INTER_CUBIC,
+                              borderMode=cv2.BORDER_REFLECT_101)
+    if unsharpen > 0:
+        arr = np.asarray(Image.fromarray(arr).filter(ImageFilter.UnsharpMask(radius=2, percent=int(unsharpen))))
+    return arr
 
-    else:
-        image = Image.fromarray(cv2.cvtColor(exposure.match_histograms(
-            cv2.cvtColor(
-                np.asarray(original_image),
-                cv2.COLOR_RGB2LAB
-            ),
-            correction,
-            channel_axis=2
-        ), cv2.COLOR_LAB2RGB).astype("uint8")).convert('RGBA')
 
-        # This line breaks it
-        # image = blendLayers(image, original_image, BlendType.LUMINOSITY)
+class ColorCorrection:
+    """
+    Colour correction towards a reference image, matching each LAB channel's histogram to the reference's, as
+    skimage.exposure.match_histograms does but much quicker. The reference histograms are worked out once, each frame
+    then only needs its own histograms to build a lookup table per LAB channel. With a mask, only the part of the frame
+    the mask covers is corrected.
+    """
 
-    return image
\ No newline at end of file
+    def __init__(self, image: Image):
+        reference = cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2LAB)
+        self.size = reference.shape[0] * reference.shape[1]
+        # Values in each channel of the reference, and the quantile at each of them.
+        self.values = []
+        self.quantiles = []
+        for channel in range(3):
+            counts = np.bincount(reference[..., channel].reshape(-1), minlength=256)
+            values = np.nonzero(counts)[0]
+            self.values.append(values)
+            self.quantiles.append(np.cumsum(counts[values]) / self.size)
+        self._mask = None
+        self._mask_source = None
+
+    def lut(self, lab: np.ndarray) -> np.ndarray:
+        # (256, 1, 3) lookup table mapping the image's LAB histograms onto the reference's.
+        pixels = lab.shape[0] * lab.shape[1]
+        lut = np.empty((256, 1, 3), dtype=np.uint8)
+        for channel in range(3):
+            quantiles = np.cumsum(np.bincount(lab[..., channel].reshape(-1), minlength=256)) / pixels
+            # Truncated like match_histograms writing back into uint8.
+            lut[:, 0, channel] = np.interp(quantiles, self.quantiles[channel], self.values[channel]).astype(np.uint8)
+        return lut
+
+    def mask(self, mask: Image, size: tuple) -> tuple:
+        # Mask at the frame size and the box it covers, only resized when the mask changes.
+        if self._mask_source is not mask or self._mask[0].size != size:
+            resized = mask.resize(size, Image.Resampling.LANCZOS)
+            self._mask = (resized, resized.getbbox())
+            self._mask_source = mask
+        return self._mask
+
+    def apply(self, image: Image, mask: Image = None) -> Image:
+        return Image.fromarray(self.apply_array(frames.to_array(image), mask), 'RGBA')
+
+    def apply_array(self, arr: np.ndarray, mask: Image = None) -> np.ndarray:
+        # Corrected RGBA array of an RGBA array.
+        lab = cv2.cvtColor(arr, cv2.COLOR_RGB2LAB)
+        lut = self.lut(lab)
+
+        if not mask:
+            return cv2.cvtColor(cv2.cvtColor(cv2.LUT(lab, lut), cv2.COLOR_LAB2RGB), cv2.COLOR_RGB2RGBA)
+
+        # Histograms come from the whole frame, but only the masked box needs correcting.
+        mask, box = self.mask(mask, (arr.shape[1], arr.shape[0]))
+        if box is None:
+            return arr
+        left, top, right, bottom = box
+        corrected = cv2.cvtColor(cv2.cvtColor(cv2.LUT(lab[top:bottom, left:right], lut), cv2.COLOR_LAB2RGB),
+                                 cv2.COLOR_RGB2RGBA)
+        result = arr.copy()
+        result[top:bottom, left:right] = np.asarray(Image.composite(Image.fromarray(corrected, 'RGBA'),
+                                                                    Image.fromarray(arr[top:bottom, left:right],
+                                                                                    'RGBA'),
+                                                                    mask.crop(box)))
+        return result
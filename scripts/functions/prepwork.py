@@ -1,6 +1,19 @@
+from contextlib import contextmanager
 from typing import Tuple
+import torch
 from PIL import Image
-from modules import processing, shared, sd_samplers
+from modules import devices, processing, shared, sd_samplers
+
+
+# Per image subseed strengths work by wrapping processing.create_random_tensors. WebUI versions that make the noise
+# with ImageRNG never call it, so there batches are cut wherever the strength changes instead.
+PER_IMAGE_SUBSEED_STRENGTH = hasattr(processing, 'create_random_tensors') and \
+    not hasattr(getattr(processing, 'rng', None), 'ImageRNG')
+
+
+def same_subseed_strength(schedule, frame_a: int, frame_b: int) -> bool:
+    # Whether two frames can be in one batch as far as the subseed strength goes.
+    return PER_IMAGE_SUBSEED_STRENGTH or schedule.subseed_strength[frame_a] == schedule.subseed_strength[frame_b]
 
 
 def setup_processors(mysettings: dict) -> Tuple[processing.StableDiffusionProcessingTxt2Img,
@@ -82,3 +95,85 @@ def setup_processors(mysettings: dict) -> Tuple[processing.StableDiffusionProces
 
 
     return ptxt, pimg
+
+
+def set_frame_parameters(p: processing.StableDiffusionProcessing, schedule, batch: list, variations: int = 1) -> list:
+    """
+    Fill a processing object with the prompts and seeds of a batch of frames from the schedule. Each frame keeps its
+    own values, returns the subseed strengths to be used with per_image_subseed_strength().
+    With variations, each frame is repeated that many times with the seeds stepped by one, like a webui batch.
+    """
+    prompts = [schedule.prompt(frame_no) for frame_no in batch for _ in range(variations)]
+    seeds = [(seed + variation, None if subseed is None else subseed + variation, strength)
+             for seed, subseed, strength in (schedule.seeds(frame_no) for frame_no in batch)
+             for variation in range(variations)]
+
+    p.batch_size = len(seeds)
+    p.prompt = [pos for pos, neg in prompts]
+    p.negative_prompt = [neg for pos, neg in prompts]
+    p.seed = [seed for seed, subseed, strength in seeds]
+    # Sub-seeds are only used when the strength is above zero, which means seed travel is on and they are set.
+    p.subseed = [0 if subseed is None else subseed for seed, subseed, strength in seeds]
+    p.denoising_strength = float(schedule.denoise[batch[0]])
+    # print(f"Frames:{batch} Seeds:{p.seed} Subs:{p.subseed}")
+
+    return [strength for seed, subseed, strength in seeds]
+
+
+@contextmanager
+def per_image_subseed_strength(p: processing.StableDiffusionProcessing, strengths: list):
+    """
+    WebUI only takes one subseed strength per processing call, which stops seed travel frames from being batched.
+    While active, the initial noise is created for each image on its own with its own strength, then stacked, along
+    with the per step noise of ancestral samplers, so each frame comes out as it would in a batch of one.
+    Raises if webui made the noise without it, rather than silently using one strength for the whole batch.
+    """
+    p.subseed_strength = strengths[0]
+    if all(strength == strengths[0] for strength in strengths):
+        # Nothing to do, a single value works for the whole batch.
+        yield
+        return
+
+    original_create_random_tensors = processing.create_random_tensors
+
+    called = []
+
+    def create_random_tensors(shape, seeds, subseeds=None, subseed_strength=0.0, **kwargs):
+        called.append(True)
+        proc = kwargs.get('p', p)
+        sampler = getattr(proc, 'sampler', None)
+        needed = sampler.number_of_needed_noises(proc) if hasattr(sampler, 'number_of_needed_noises') else 0
+        resize_h = kwargs.get('seed_resize_from_h', 0)
+        resize_w = kwargs.get('seed_resize_from_w', 0)
+        noise_shape = shape if resize_h <= 0 or resize_w <= 0 else (shape[0], resize_h // 8, resize_w // 8)
+        noises = []
+        sampler_noises = []
+        for idx, seed in enumerate(seeds):
+            if sampler is not None:
+                sampler.sampler_noises = None
+            noises.append(original_create_random_tensors(shape, [seed],
+                                                         subseeds=None if subseeds is None else [subseeds[idx]],
+                                                         subseed_strength=strengths[idx],
+                                                         **kwargs))
+            if needed == 0:
+                continue
+            if sampler.sampler_noises is not None:
+                # Made by webui, seeded with the eta noise seed delta.
+                sampler_noises.append([n[0] for n in sampler.sampler_noises])
+            else:
+                # Per step noise for ancestral samplers, drawn on from where this image's seed left the generator,
+                # as webui does for batches. Without it a batch would share the global generator's noise, and the
+                # frames would change with what else is in the batch.
+                sampler_noises.append([devices.randn_without_seed(noise_shape) for _ in range(needed)])
+        if needed > 0:
+            sampler.sampler_noises = [torch.stack(n).to(shared.device) for n in zip(*sampler_noises)]
+        return torch.cat(noises)
+
+    processing.create_random_tensors = create_random_tensors
+    try:
+        yield
+    finally:
+        processing.create_random_tensors = original_create_random_tensors
+    if len(called) == 0 and not shared.state.interrupted:
+        raise RuntimeError("WebUI did not make the noise through create_random_tensors, the per frame subseed "
+                           "strengths were not used. Set the batch size to 1.")
@@ -0,0 +1,90 @@
+import os
+from collections import OrderedDict
+
+from PIL import Image
+
+from scripts.functions import events
+
+# Default memory for decoded props, in MB.
+DEFAULT_BUDGET_MB = 512
+
+
+class PropCache:
+    """
+    Prop and stamp pictures, decoded once and kept scaled and rotated, ready to paste. Sprites are keyed on the file,
+    its modified time, the scale and the rotation, so a file changed on disk is read again. The least recently used
+    ones are dropped once they take up more than the memory budget.
+    """
+
+    def __init__(self, budget_mb: int = DEFAULT_BUDGET_MB):
+        self.budget = int(budget_mb) * 1024 * 1024
+        self.used = 0
+        self._sprites = OrderedDict()
+
+    def _get(self, key: tuple):
+        sprite = self._sprites.get(key)
+        if sprite is not None:
+            self._sprites.move_to_end(key)
+        return sprite
+
+    def _put(self, key: tuple, sprite: Image):
+        self._sprites[key] = sprite
+        self.used += sprite.width * sprite.height * 4
+        # Always keep the one just added, even if it is over budget on its own.
+        while self.used > self.budget and len(self._sprites) > 1:
+            old_key, old = self._sprites.popitem(last=False)
+            self.used -= old.width * old.height * 4
+
+    def sprite(self, filename: str, scale: float = 1.0, rotation: float = 0.0) -> Image:
+        # RGBA prop scaled then rotated (degrees, counter clockwise, expanded to fit), as paste_prop always did.
+        # Raises OSError if the file is missing or can't be read.
+        filename = os.path.normpath(filename)
+        mtime = os.path.getmtime(filename)
+        key = (filename, mtime, float(scale), float(rotation))
+        sprite = self._get(key)
+        if sprite is not None:
+            return sprite
+
+        # The decoded file is kept too, so other scales and rotations of it don't read it again.
+        decoded_key = (filename, mtime, None, None)
+        prop = self._get(decoded_key)
+        if prop is None:
+            with Image.open(filename) as f:
+                prop = f.copy()
+            self._put(decoded_key, prop)
+
+        # Transformed in the file's own mode, so the corners of rotated RGB props stay black as before.
+        w, h = prop.size
+        sprite = prop.resize((int(w * scale), int(h * scale)), Image.Resampling.LANCZOS).rotate(rotation, expand=True)
+        if sprite.mode != 'RGBA':
+            sprite = sprite.convert('RGBA')
+        self._put(key, sprite)
+        return sprite
+
+    def clear(self):
+        self._sprites.clear()
+        self.used = 0
+
+
+# Shared by everything that pastes props in this process.
+sprites = PropCache()
+
+
+def preload(keyframe_events, prop_folder: str) -> list:
+    """
+    Load the sprites for every prop and stamp in the keyframes before rendering starts. Returns the files that are
+    missing or can't be read, after printing them, so a bad path shows up before the first frame rather than partway
+    through.
+    """
+    missing = []
+    for event in keyframe_events:
+        if not isinstance(event, events.PropEvent):
+            continue
+        filename = os.path.join(prop_folder.strip(), event.filename)
+        try:
+            sprites.sprite(filename, event.scale, event.rotation)
+        except OSError:
+            if filename not in missing:
+                print("Prop: Cannot load file: " + filename)
+                missing.append(filename)
+    return missing
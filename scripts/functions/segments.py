@@ -0,0 +1,259 @@
+#
+# Segment parallel rendering for sequential mode.
+# Frames don't depend on each other when not in loopback mode, so the timeline can be split into segments and rendered
+# by a pool of worker processes, one per configured device. Smoothing frames between segments are filled in when they
+# are stitched back together, so the result is the same as rendering in one go.
+#
+# Workers don't have access to the webui model, so a device is either:
+#   stub                     CPU only, draws a deterministic picture from the seed. For testing.
+#   http://host:port         Another webui instance started with --api, typically one per GPU.
+#
+# Workers are started with spawn rather than fork, so they don't inherit webui's CUDA context or its threads. Spawn
+# imports this module fresh in each worker, along with the main module of the webui process, which only starts webui
+# under an if __name__ == '__main__' guard. This module must not import anything from webui, the workers are entered
+# through _init_worker() and render_segment() only.
+import base64
+import io
+import json
+import multiprocessing
+import os
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+from PIL import Image
+
+from scripts.functions import events, frame_store, frame_writer, postprocessing
+
+# Number of segments queued per device, so a fast device picks up more of the work.
+SEGMENTS_PER_DEVICE = 4
+
+
+def split_segments(frame_count: int, segment_count: int) -> list:
+    # Contiguous (start, stop) frame ranges, as even as possible.
+    segment_count = max(1, min(segment_count, frame_count))
+    bounds = np.linspace(0, frame_count, segment_count + 1).round().astype(int)
+    return [(int(bounds[i]), int(bounds[i + 1])) for i in range(segment_count)]
+
+
+def frame_index(frame_no: int, settings: dict) -> int:
+    # File number of a rendered frame, smoothing frames are inserted before every frame but the first.
+    if settings['smoothing'] > 0 and not settings['film_interpolation']:
+        return frame_no * (settings['smoothing'] + 1)
+    return frame_no
+
+
+def frame_filename(index: int, settings: dict) -> str:
+    return os.path.join(settings['output_path'], f"frame_{index:05}.{settings['frame_format']}")
+
+
+def save_frame(image: Image, index: int, settings: dict, store=None):
+    if store is not None:
+        store.write(index, image)
+    else:
+        frame_writer.save_frame(image, frame_filename(index, settings), settings['frame_format'],
+                                settings['frame_compression'])
+
+
+def load_frame(index: int, settings: dict, store=None) -> Image:
+    if store is not None:
+        return store.image(index)
+    return Image.open(frame_filename(index, settings))
+
+
+class StubBackend:
+    """
+    CPU only stand in for diffusion. Smooth random colour fields from the seed, blended towards the sub-seed by the
+    sub-seed strength, so seed travel can be checked without a GPU.
+    """
+
+    def __init__(self, settings: dict):
+        self.width = settings['width']
+        self.height = settings['height']
+
+    def field(self, seed: int) -> np.ndarray:
+        rng = np.random.default_rng(seed)
+        small = Image.fromarray(rng.integers(0, 256, (8, 8, 3), dtype=np.uint8), 'RGB')
+        return np.asarray(small.resize((self.width, self.height), Image.Resampling.BILINEAR), dtype=np.float32)
+
+    def generate(self, frame: dict) -> Image:
+        pixels = self.field(frame['seed'])
+        if frame['subseed'] is not None and frame['subseed_strength'] > 0:
+            pixels += (self.field(frame['subseed']) - pixels) * frame['subseed_strength']
+        return Image.fromarray(pixels.round().astype(np.uint8), 'RGB')
+
+
+class ApiBackend:
+    """
+    Renders frames on another webui instance through its txt2img API.
+    """
+
+    def __init__(self, url: str, settings: dict):
+        self.url = url.rstrip('/') + '/sdapi/v1/txt2img'
+        self.settings = settings
+
+    def generate(self, frame: dict) -> Image:
+        payload = {'prompt': frame['prompt'],
+                   'negative_prompt': frame['negative_prompt'],
+                   'seed': frame['seed'],
+                   'subseed': -1 if frame['subseed'] is None else frame['subseed'],
+                   'subseed_strength': frame['subseed_strength'],
+                   'sampler_name': self.settings['txt_sampler_name'],
+                   'steps': self.settings['steps'],
+                   'cfg_scale': self.settings['cfg_scale'],
+                   'width': self.settings['width'],
+                   'height': self.settings['height'],
+                   'restore_faces': self.settings['restore_faces'],
+                   'batch_size': 1,
+                   'n_iter': 1}
+        if frame['checkpoint'] is not None:
+            payload['override_settings'] = {'sd_model_checkpoint': frame['checkpoint']}
+            payload['override_settings_restore_afterwards'] = False
+
+        request = urllib.request.Request(self.url, data=json.dumps(payload).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            result = json.loads(response.read().decode('utf-8'))
+        return Image.open(io.BytesIO(base64.b64decode(result['images'][0].split(',', 1)[-1])))
+
+
+def make_backend(device: str, settings: dict):
+    if device.lower() == 'stub':
+        return StubBackend(settings)
+    elif device.lower().startswith('http'):
+        return ApiBackend(device, settings)
+    raise ValueError(f"Unknown segment device: {device}")
+
+
+# Backend of the current worker process, picked from the queue of devices when the worker starts.
+_backend = None
+# Frame store the worker writes into, if frames are kept in one.
+_store = None
+
+
+def _init_worker(device_queue, settings: dict):
+    global _backend, _store
+    _backend = make_backend(device_queue.get(), settings)
+    if settings['frame_format'] == 'raw':
+        _store = frame_store.FrameStore.open(settings['output_path'])
+
+
+def render_segment(settings: dict, frames: list, stamps: dict, text_blocks: dict) -> tuple:
+    """
+    Worker: render, post process and save a run of frames, with the smoothing frames between them. Smoothing into the
+    first frame is left for the stitching, as the frame before it belongs to another segment.
+    Returns the frame range, and the first and last frames as RGBA arrays to stitch from. They are handed back rather
+    than read from the saved frames, which may be lossy.
+    """
+    overlay = postprocessing.Overlay(settings['prop_folder'], stamps, text_blocks)
+    first_frame = None
+    last_frame = None
+    for frame in frames:
+        for event in frame['events']:
+            overlay.apply_event(event)
+
+        image = overlay.apply(_backend.generate(frame))
+
+        index = frame_index(frame['frame_no'], settings)
+        if last_frame is not None and settings['smoothing'] > 0 and not settings['film_interpolation']:
+            for idx, img in enumerate(postprocessing.interpolate(last_frame, image, settings['smoothing'],
+                                                                 settings['flow_smoothing'])):
+                save_frame(img, index - settings['smoothing'] + idx, settings, _store)
+
+        save_frame(image, index, settings, _store)
+        if first_frame is None:
+            first_frame = image
+        last_frame = image
+
+    if _store is not None:
+        _store.flush()
+
+    return frames[0]['frame_no'], frames[-1]['frame_no'] + 1, np.asarray(first_frame), np.asarray(last_frame)
+
+
+def stitch(settings: dict, start_frame: int, previous: np.ndarray, current: np.ndarray, store=None):
+    # Smoothing frames leading into the first frame of a segment, from the last frame of the one before.
+    if start_frame == 0 or settings['smoothing'] == 0 or settings['film_interpolation']:
+        return
+    index = frame_index(start_frame, settings)
+    for idx, img in enumerate(postprocessing.interpolate(previous, current, settings['smoothing'],
+                                                         settings['flow_smoothing'])):
+        save_frame(img, index - settings['smoothing'] + idx, settings, store)
+
+
+def render(myset: dict, schedule, devices: list, prop_folder: str, interrupted=lambda: False, store=None,
+           progress=lambda frames_done, image: None) -> list:
+    """
+    Render the whole schedule across the devices. Returns the frame numbers that were completed, in order.
+    With a frame store, it must already be big enough for every frame, the workers write straight into it.
+    progress is called as each segment finishes, with the number of frames done so far and the segment's last frame.
+    """
+    settings = {k: myset[k] for k in ['width', 'height', 'steps', 'cfg_scale', 'txt_sampler_name', 'restore_faces',
+                                      'smoothing', 'film_interpolation', 'flow_smoothing', 'output_path',
+                                      'frame_format', 'frame_compression']}
+    settings['prop_folder'] = prop_folder
+
+    # Per frame parameters, and the model that should be loaded at that frame. Models are sent by their checkpoint
+    # title, as resolved when the keyframes were read, so the worker loads the same checkpoint as a local render would.
+    frames = []
+    checkpoint = None
+    for frame_no in range(schedule.frame_count - 1):
+        frame_events = schedule.events_at(frame_no)
+        for event in frame_events:
+            if isinstance(event, events.ModelEvent):
+                checkpoint = event.checkpoint.title
+        prompt, negative_prompt = schedule.prompt(frame_no)
+        seed, subseed, subseed_strength = schedule.seeds(frame_no)
+        frames.append({'frame_no': frame_no, 'prompt': prompt, 'negative_prompt': negative_prompt, 'seed': seed,
+                       'subseed': subseed, 'subseed_strength': subseed_strength, 'checkpoint': checkpoint,
+                       'events': [e for e in frame_events if not isinstance(e, events.ModelEvent)]})
+
+    context = multiprocessing.get_context('spawn')
+    device_queue = context.Queue()
+    for device in devices:
+        device_queue.put(device)
+
+    done = []
+    # First and last frame of each finished segment, by its start and stop.
+    first_frames = {}
+    last_frames = {}
+    with ProcessPoolExecutor(max_workers=len(devices), mp_context=context, initializer=_init_worker,
+                             initargs=(device_queue, settings)) as executor:
+        pending = set()
+        # Only keeps track of the stamps and text blocks active at the start of each segment, nothing is drawn here.
+        overlay = postprocessing.Overlay(prop_folder)
+        for start, stop in split_segments(len(frames), len(devices) * SEGMENTS_PER_DEVICE):
+            pending.add(executor.submit(render_segment, settings, frames[start:stop], dict(overlay.stamps),
+                                        dict(overlay.text_blocks)))
+            for frame in frames[start:stop]:
+                for event in frame['events']:
+                    overlay.apply_event(event)
+
+        while len(pending) > 0:
+            finished, pending = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+            for future in finished:
+                start, stop, first_frames[start], last_frames[stop] = future.result()
+                print(f"Segment done: frames {start} to {stop - 1}")
+                done.append((start, stop))
+                progress(sum(b - a for a, b in done), Image.fromarray(last_frames[stop], 'RGBA'))
+            if interrupted():
+                for future in pending:
+                    future.cancel()
+                break
+
+    # Stitch segments that finished next to each other, up to the first gap if interrupted.
+    done.sort()
+    completed = []
+    for start, stop in done:
+        if start != len(completed):
+            break
+        completed.extend(range(start, stop))
+    if store is not None and len(completed) > 0:
+        store.count = frame_index(completed[-1], settings) + 1
+    for start, stop in done:
+        if start >= len(completed):
+            break
+        if start > 0:
+            stitch(settings, start, last_frames[start], first_frames[start], store)
+
+    return completed
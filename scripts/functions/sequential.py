@@ -1,168 +1,162 @@
 import math
 import os
 
-import cv2
-from PIL import Image
-
-from scripts.functions import keyframe_functions, postprocessing
+from scripts.functions import frame_writer, keyframe_functions, postprocessing, prepwork, prop_cache, segments, \
+    sources
 from modules import processing, shared, sd_models
 from modules.processing import Processed
 from modules.shared import state
+from PIL import Image
 
 
-def main_process(myset: dict,
-                 ptxt: processing.StableDiffusionProcessingTxt2Img) -> any:
+def batch_frames(schedule: keyframe_functions.FrameSchedule, start: int, stop: int, batch_size: int) -> list:
+    """
+    List of consecutive frame numbers from start that can be generated in one call. A batch is cut short at a model
+    change, so the new model is loaded before that frame is generated. It is also cut where the subseed strength
+    changes, unless per image strengths work in this webui version.
+    """
+    batch = [start]
+    while len(batch) < batch_size and batch[-1] + 1 < stop:
+        if any(isinstance(e, keyframe_functions.ModelEvent) for e in schedule.events_at(batch[-1] + 1)) or \
+                not prepwork.same_subseed_strength(schedule, start, batch[-1] + 1):
+            break
+        batch.append(batch[-1] + 1)
+    return batch
 
-    frame_count = math.ceil(myset['fps'] * myset['total_time'])
-    shared.state.job_count = frame_count
 
-    df = keyframe_functions.process_keyframes(myset)
+def generate_batch(schedule: keyframe_functions.FrameSchedule,
+                   ptxt: processing.StableDiffusionProcessingTxt2Img,
+                   batch: list) -> list:
+    strengths = prepwork.set_frame_parameters(ptxt, schedule, batch)
+    with prepwork.per_image_subseed_strength(ptxt, strengths):
+        processed = processing.process_images(ptxt)
 
-    all_images = []
+    return processed.images[processed.index_of_first_image:processed.index_of_first_image + len(batch)]
 
-    state.job_count = frame_count
 
-    # Need to check input source and load video if required.
-    if myset['source'] == 'video':
-        source_cap = cv2.VideoCapture(myset['source_file'])
-    else:
-        source_cap = None
+def segment_devices() -> list:
+    # Worker devices set up to render segments on, see segments.
+    return [d.strip() for d in shared.opts.animatoranon_segment_devices.split(',') if len(d.strip()) > 0]
 
-    # Post Processing object dicts
-    text_blocks = {}
-    props = {}
-    stamps = {}
 
-    last_frame = None
-    frame_save = 0
+def segment_progress(frames_done: int, image: Image):
+    # Show segment rendering in the webui progress bar, which otherwise only moves as process_images runs.
+    state.job_no = frames_done
+    state.current_image = image
 
-    # Main loop through frames
-    for frame_no in range(frame_count):
 
-        if state.interrupted:
-            # Interrupt button pressed in WebUI
-            break
+def main_process(myset: dict,
+                 ptxt: processing.StableDiffusionProcessingTxt2Img,
+                 writer: frame_writer.FrameWriter) -> any:
 
-        #
-        # Process Keyframes
-        #
-        # Check if keyframes exists for this frame
-        # print("process keyframes")
-        if frame_no in myset['keyframes']:
-            # Keyframes exist for this frame.
-            # print(f"\r\nKeyframe at {frame_no}: {myset['keyframes'][frame_no]}\r\n")
-
-            for keyframe in myset['keyframes'][frame_no]:
-                keyframe_command = keyframe[0].lower().strip()
-                # Check the command, should be first item.
-                if keyframe_command == "model" and len(keyframe) == 2:
+    frame_count = math.ceil(myset['fps'] * myset['total_time'])
+    shared.state.job_count = frame_count
+
+    schedule = keyframe_functions.compile_schedule(myset, keyframe_functions.process_keyframes(myset))
+    # Decode props and stamps up front, so missing files are reported before the first frame.
+    prop_cache.preload(schedule.events, shared.opts.animatoranon_prop_folder)
+
+    all_images = []
+
+    state.job_count = frame_count
+
+    # Source frames are read ahead in the background, at the animation frame rate and size.
+    with sources.open_source(myset, shared.opts.animatoranon_source_cache.strip(),
+                             shared.opts.animatoranon_source_cache_mb) as source_cap:
+        # Split the timeline across worker devices if any are set up.
+        devices = segment_devices()
+        if len(devices) > 0 and source_cap is None:
+            store = writer.store(myset['output_path'])
+            completed = segments.render(myset, schedule, devices, shared.opts.animatoranon_prop_folder,
+                                        lambda: state.interrupted, store, segment_progress)
+            all_images = [segments.load_frame(segments.frame_index(frame_no, myset), myset, store).copy()
+                          for frame_no in completed if frame_no % int(myset['fps']) == 0]
+            Processed(ptxt, all_images, 0, "")
+            print("Done.")
+            return all_images
+
+        # Frames only need to be generated one at a time if they come from a source.
+        batch_size = max(1, int(myset['batch_size'])) if source_cap is None else 1
+
+        # Post Processing objects, stamps and text blocks are drawn on every frame until cleared.
+        props = {}
+        overlay = postprocessing.Overlay(shared.opts.animatoranon_prop_folder)
+
+        last_frame = None
+        frame_save = 0
+        ext = myset['frame_format']
+
+        # Main loop through batches of frames
+        frame_no = 0
+        while frame_no < frame_count:
+
+            if state.interrupted:
+                # Interrupt button pressed in WebUI
+                break
+
+            batch = batch_frames(schedule, frame_no, frame_count, batch_size)
+
+            #
+            # Process source frames into destination frames
+            #
+            # print("Animator: Process Source Frames.")
+            # Model changes can only be at the start of a batch, load it before generating.
+            for event in schedule.events_at(batch[0]):
+                if isinstance(event, keyframe_functions.ModelEvent):
                     # Time (s) | model    | model name
-                    info = sd_models.get_closet_checkpoint_match(keyframe[1].strip() + ".ckpt")
-                    if info is None:
-                        raise RuntimeError(f"Unknown checkpoint: {keyframe[1]}")
-                    sd_models.reload_model_weights(shared.sd_model, info)
-
-                elif keyframe_command == "prop" and len(keyframe) == 6:
-                    # Time (s) | prop | prop_filename | x pos | y pos | scale | rotation
-                    # bit of a hack, no prop name is supplied, but same function is used to draw.
-                    # so the command is passed in place of prop name, which will be ignored anyway.
-                    props[len(props)] = keyframe
-                elif keyframe_command == "set_stamp" and len(keyframe) == 7:
-                    # Time (s) | set_stamp | stamp_name | stamp_filename | x pos | y pos | scale | rotation
-                    stamps[keyframe[1].strip()] = keyframe[1:]
-                elif keyframe_command == "clear_stamp" and len(keyframe) == 2:
-                    # Time (s) | clear_stamp | stamp_name
-                    if keyframe[1].strip() in stamps:
-                        stamps.pop(keyframe[1].strip())
-
-                elif keyframe_command == "set_text" and len(keyframe) == 10:
-                    # time_s | set_text | name | text_prompt | x | y | w | h | fore_color | back_color | font_name
-                    text_blocks[keyframe[1].strip()] = keyframe[1:]
-                elif keyframe_command == "clear_text" and len(keyframe) == 2:
-                    # Time (s) | clear_text | textblock_name
-                    if keyframe[1].strip() in text_blocks:
-                        text_blocks.pop(keyframe[1].strip())
-
-        #
-        # Get source frame
-        #
-        # print("Animator: Get/Generate Source Image.")
-
-
-        #
-        # Pre-process source frame
-        #
-        # print("Animator: Pre-process Source Frame.")
-
-        #
-        # Process source frame into destination frame
-        #
-        # print("Animator: Process Source Frame.")
-
-        # Set prompts
-        ptxt.prompt = str(df.loc[frame_no, ['pos_prompt']][0])
-        ptxt.negative_prompt = str(df.loc[frame_no, ['neg_prompt']][0])
-
-        ptxt.seed = int(df.loc[frame_no, ['seed_start']][0])
-        ptxt.subseed = None \
-            if df.loc[frame_no, ['seed_end']][0] is None else int(df.loc[frame_no, ['seed_end']][0])
-        ptxt.subseed_strength = None \
-            if df.loc[frame_no, ['seed_str']][0] is None else float(df.loc[frame_no, ['seed_str']][0])
-        # print(f"Frame:{frame_no} Seed:{ptxt.seed} Sub:{ptxt.subseed} Str:{ptxt.subseed_strength}")
-
-        ptxt.denoising_strength = df.loc[frame_no, ['denoise']][0]
-
-        # Check if a source is set, and grab frame from there. If not, process.
-        # TODO: Maybe figure out blending options for source frame and generated frame.
-        if myset['source'] == 'video':
-            source_cap.set(1, frame_no)
-            ret, tmp_array = source_cap.read()
-            post_processed_image = Image.fromarray(cv2.cvtColor(tmp_array, cv2.COLOR_BGR2RGB).astype('uint8'), 'RGB')
-        elif myset['source'] == 'images':
-            if frame_no >= len(source_cap):
-                post_processed_image = Image.open(source_cap[-1])
-                print('Out of frames, reverting to last frame!')
+                    sd_models.reload_model_weights(shared.sd_model, event.checkpoint)
+
+            # Check if a source is set, and grab frame from there. If not, process.
+            # TODO: Maybe figure out blending options for source frame and generated frame.
+            if source_cap is not None:
+                images = [source_cap.frame(frame_no)]
             else:
-                post_processed_image = Image.open(source_cap[frame_no])
-
-        else:
-            processed = processing.process_images(ptxt)
-            post_processed_image = processed.images[0].copy()
-
-        if post_processed_image.mode != 'RGBA':
-            post_processed_image = post_processed_image.convert('RGBA')
-        #
-        # Post-process destination frame
-        #
-        # print("Animator: Post-Process Source Frame.")
-        if len(stamps) > 0:
-            post_processed_image = postprocessing.paste_prop(post_processed_image,
-                                                             stamps,
-                                                             shared.opts.animatoranon_prop_folder)
-        if len(text_blocks) > 0:
-            post_processed_image = postprocessing.render_text_block(post_processed_image, text_blocks)
-
-        #
-        # Save frame
-        #
-        # Create and save smoothed intermediate frames
-        if frame_no > 0 and myset['smoothing'] > 0 and not myset['film_interpolation']:
-            # working a frame behind, smooth from last_frame -> post_processed_image
-            for idx, img in enumerate(postprocessing.morph(last_frame, post_processed_image, myset['smoothing'])):
-                img.save(os.path.join(myset['output_path'], f"frame_{frame_save:05}.png"))
-                print(f"{frame_save:03}: {frame_no:03} > {idx} smooth frame")
+                images = [image.copy() for image in generate_batch(schedule, ptxt, batch)]
+
+            # Post process and save the batch in frame order.
+            for frame_no, post_processed_image in zip(batch, images):
+
+                #
+                # Process Keyframes
+                #
+                for event in schedule.events_at(frame_no):
+                    if type(event) is keyframe_functions.PropEvent:
+                        # Time (s) | prop | prop_filename | x pos | y pos | scale | rotation
+                        props[len(props)] = event
+                    else:
+                        # Stamps and text blocks
+                        overlay.apply_event(event)
+
+                #
+                # Post-process destination frame
+                #
+                # print("Animator: Post-Process Source Frame.")
+                post_processed_image = overlay.apply(post_processed_image)
+
+                #
+                # Save frame
+                #
+                # Create and save smoothed intermediate frames
+                if frame_no > 0 and myset['smoothing'] > 0 and not myset['film_interpolation']:
+                    # working a frame behind, smooth from last_frame -> post_processed_image
+                    for idx, img in enumerate(postprocessing.interpolate(last_frame, post_processed_image,
+                                                                         myset['smoothing'], myset['flow_smoothing'])):
+                        writer.frame(img, os.path.join(myset['output_path'], f"frame_{frame_save:05}.{ext}"))
+                        print(f"{frame_save:03}: {frame_no:03} > {idx} smooth frame")
+                        frame_save += 1
+
+                # print("Animator: Save Frame")
+                if frame_no % int(myset['fps']) == 0:
+                    all_images.append(post_processed_image)
+
+                writer.frame(post_processed_image, os.path.join(myset['output_path'], f"frame_{frame_save:05}.{ext}"))
                 frame_save += 1
 
-        # print("Animator: Save Frame")
-        if frame_no % int(myset['fps']) == 0:
-            all_images.append(post_processed_image)
-
-        post_processed_image.save(os.path.join(myset['output_path'], f"frame_{frame_save:05}.png"))
-        frame_save += 1
+                last_frame = post_processed_image.copy()
 
-        last_frame = post_processed_image.copy()
+                shared.state.current_image = post_processed_image
 
-        shared.state.current_image = post_processed_image
+            frame_no = batch[-1] + 1
 
     Processed(ptxt, all_images, 0, "")
     print("Done.")
@@ -0,0 +1,244 @@
+#
+# Source frames for the animation, read ahead in the background while frames are being generated.
+#
+import contextlib
+import glob
+import hashlib
+import os
+import queue
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from scripts.functions import frames
+
+# Default size limit of the source image cache folder, in MB.
+DEFAULT_CACHE_MB = 2048
+
+
+def natural_key(filename: str) -> list:
+    # Sort key with runs of digits compared as numbers, so frame_2 comes before frame_10.
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', filename)]
+
+
+def image_files(pattern: str) -> list:
+    # Files matching a wildcard pattern, in natural order.
+    return sorted(glob.glob(pattern), key=natural_key)
+
+
+def resize_frame(arr: np.ndarray, size: tuple) -> np.ndarray:
+    # Area averaging when shrinking, cubic when enlarging.
+    if size is None or (arr.shape[1], arr.shape[0]) == tuple(size):
+        return arr
+    shrinking = size[0] * size[1] < arr.shape[0] * arr.shape[1]
+    return cv2.resize(arr, tuple(size), interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_CUBIC)
+
+
+class VideoSource:
+    """
+    Frames of a video file at the animation frame rate. The video is decoded start to finish by a background thread,
+    a few frames ahead of the render loop, rather than seeking to each frame, which decodes again from the last key
+    frame every time. Source frames are picked by time, nearest first, so a video with a different frame rate keeps
+    its speed: frames are skipped or repeated as needed. Frames can be resized to the animation size as they are
+    decoded.
+    Frames must be asked for in order. Past the end of the video, the last frame is repeated.
+    """
+
+    def __init__(self, filename: str, fps: float, size: tuple = None, prefetch: int = 8):
+        self._cap = cv2.VideoCapture(filename)
+        if not self._cap.isOpened():
+            raise RuntimeError(f"Cannot open source video: {filename}")
+        self.fps = float(fps)
+        self.source_fps = self._cap.get(cv2.CAP_PROP_FPS) or self.fps
+        self.size = size
+        self._queue = queue.Queue(maxsize=max(1, int(prefetch)))
+        self._stop = threading.Event()
+        self._error = None
+        self._next = 0
+        self._last = None
+        self._ended = False
+        self._thread = threading.Thread(target=self._decode_loop, name='animator_video_source', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def source_index(self, frame_no: int) -> int:
+        # Source frame nearest the time of an animation frame.
+        return int(frame_no * self.source_fps / self.fps + 0.5)
+
+    def _put(self, item) -> bool:
+        # Wait for room in the queue, unless closed.
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _decode_loop(self):
+        try:
+            frame_no = 0
+            index = 0
+            while not self._stop.is_set():
+                ret, bgr = self._cap.read()
+                if not ret or bgr is None:
+                    break
+                # The same source frame can be used for several animation frames, or none.
+                target = self.source_index(frame_no)
+                if target > index:
+                    index += 1
+                    continue
+                rgb = resize_frame(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB), self.size)
+                while self.source_index(frame_no) == index:
+                    if not self._put(rgb):
+                        return
+                    frame_no += 1
+                index += 1
+        except Exception as e:
+            self._error = e
+        finally:
+            # End of the video.
+            self._put(None)
+
+    def frame(self, frame_no: int) -> Image:
+        if frame_no < self._next:
+            raise RuntimeError(f"Video source frames must be read in order, frame {frame_no} was already read.")
+        while self._next <= frame_no and not self._ended:
+            arr = self._queue.get()
+            if arr is None:
+                self._ended = True
+                if self._error is not None:
+                    raise self._error
+                if self._last is None:
+                    raise RuntimeError("Source video has no frames.")
+                print('Out of frames, reverting to last frame!')
+                break
+            self._last = arr
+            self._next += 1
+        self._next = max(self._next, frame_no + 1)
+        return Image.fromarray(self._last, 'RGB')
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._cap.release()
+
+
+class ImageSequenceSource:
+    """
+    Frames from a list of image files, one per animation frame, in order. The next few frames are opened, converted to
+    RGBA and resized to the animation size on a thread pool ahead of the render loop. Past the last file, the last
+    frame is repeated.
+    With a cache folder, the resized frames are kept there as raw arrays, so the next run on the same files doesn't
+    decode them again. A cached frame is used as long as its file, modified time and size match. When closed, the
+    least recently used frames are deleted to keep the folder under cache_mb, which clears out ones for changed files.
+    """
+
+    def __init__(self, files: list, size: tuple = None, prefetch: int = 8, threads: int = 2, cache_folder: str = None,
+                 cache_mb: int = DEFAULT_CACHE_MB):
+        if len(files) == 0:
+            raise RuntimeError("No source images.")
+        self.files = list(files)
+        self.size = size
+        self.prefetch = max(1, int(prefetch))
+        self.cache_folder = cache_folder if cache_folder else None
+        self.cache_mb = cache_mb
+        if self.cache_folder is not None:
+            os.makedirs(self.cache_folder, exist_ok=True)
+        self._pool = ThreadPoolExecutor(max_workers=max(1, int(threads)), thread_name_prefix='animator_image_source')
+        self._pending = {}
+        self._last = None
+        self._ended = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def cache_filename(self, filename: str) -> str:
+        key = f"{os.path.abspath(filename)}|{os.path.getmtime(filename)}|{self.size}"
+        return os.path.join(self.cache_folder, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+    def _load(self, index: int) -> np.ndarray:
+        filename = self.files[index]
+        cache_filename = None
+        if self.cache_folder is not None:
+            cache_filename = self.cache_filename(filename)
+            if os.path.exists(cache_filename):
+                arr = np.load(cache_filename)
+                # Marked as used, for pruning.
+                os.utime(cache_filename)
+                return arr
+        with Image.open(filename) as image:
+            arr = resize_frame(np.asarray(image.convert('RGBA')), self.size)
+        if cache_filename is not None:
+            # Written under a temporary name first, so a cut off write is never read back.
+            with open(cache_filename + '.tmp', 'wb') as f:
+                np.save(f, arr)
+            os.replace(cache_filename + '.tmp', cache_filename)
+        return arr
+
+    def frame(self, frame_no: int) -> Image:
+        if frame_no >= len(self.files):
+            if not self._ended:
+                print('Out of frames, reverting to last frame!')
+                self._ended = True
+            frame_no = len(self.files) - 1
+        if self._last is None or self._last[0] != frame_no:
+            self._last = (frame_no, self._get(frame_no))
+        return frames.to_image(self._last[1])
+
+    def _get(self, index: int) -> np.ndarray:
+        # Frames behind this one aren't needed any more, the ones ahead are started.
+        for old in [i for i in self._pending if i < index]:
+            self._pending.pop(old).cancel()
+        for ahead in range(index, min(index + self.prefetch, len(self.files))):
+            if ahead not in self._pending:
+                self._pending[ahead] = self._pool.submit(self._load, ahead)
+        return self._pending.pop(index).result()
+
+    def close(self):
+        self._pending = {}
+        self._pool.shutdown(cancel_futures=True)
+        if self.cache_folder is not None:
+            prune_cache(self.cache_folder, self.cache_mb)
+
+
+def prune_cache(cache_folder: str, cache_mb: int):
+    # Delete the least recently used cached frames until the folder is under cache_mb, and any cut off writes.
+    entries = []
+    for entry in os.scandir(cache_folder):
+        if entry.name.endswith('.npy.tmp'):
+            os.remove(entry.path)
+        elif entry.name.endswith('.npy'):
+            info = entry.stat()
+            entries.append((info.st_mtime, info.st_size, entry.path))
+    used = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if used <= int(cache_mb) * 1024 * 1024:
+            break
+        os.remove(path)
+        used -= size
+
+
+def open_source(myset: dict, cache_folder: str = None, cache_mb: int = DEFAULT_CACHE_MB):
+    """
+    Reader for the source frames set in the keyframes, to use in a with block so its threads and files are closed
+    however rendering ends. The with block gives None if frames are generated.
+    """
+    if myset['source'] == 'video':
+        return VideoSource(myset['source_file'], myset['fps'], (myset['width'], myset['height']))
+    elif myset['source'] == 'images':
+        return ImageSequenceSource(myset['source_file'], (myset['width'], myset['height']), cache_folder=cache_folder,
+                                   cache_mb=cache_mb)
+    return contextlib.nullcontext()